@@ -0,0 +1,307 @@
+"""Benchmarks of the generator on a synthetic, reproducible corpus of simfiles.
+
+$ poetry run python benchmarks/bench.py --simfiles 2000 --output results.json
+
+Results are written as json, so that they can be compared between releases.
+"""
+
+import argparse
+import contextlib
+import datetime
+import importlib.metadata
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from sm_db_gen import gen
+from sm_db_gen.db import STORAGE_DRIVERS, SQLiteStorage
+
+ARROWS = ("1", "2", "3", "4", "M")
+
+
+class CorpusConfig:
+    __slots__ = (
+        "simfiles",
+        "packs",
+        "densities",
+        "measures",
+        "bpm_changes",
+        "duplicate_ratio",
+        "malformed_ratio",
+        "odd_encoding_ratio",
+        "seed",
+    )
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+def generate_measure(rng: random.Random, rows: int, panels: int = 4) -> str:
+    # notes are placed on a grid coarser than the measure, so that minimization has something to do
+    grid = rng.choice([d for d in (1, 2, 4, 8, 16, 48) if rows % d == 0 and d <= rows])
+    beats = []
+    for i in range(rows):
+        if i % (rows // grid) == 0 and rng.random() < 0.6:
+            beat = ["0"] * panels
+            beat[rng.randrange(panels)] = rng.choice(ARROWS)
+            beats.append("".join(beat))
+        else:
+            beats.append("0" * panels)
+
+    return "\n".join(beats)
+
+
+def generate_bpms(rng: random.Random, changes: int) -> str:
+    beats = sorted(rng.sample(range(1, 400), changes))
+    return ",\n".join(f"{beat:.3f}={rng.uniform(60, 300):.3f}" for beat in [0, *beats])
+
+
+def generate_simfile(rng: random.Random, config: CorpusConfig, title: str) -> bytes:
+    bpm_changes = rng.randint(0, config.bpm_changes)
+    text = (
+        f"#TITLE:{title};\n"
+        f"#SUBTITLE:;\n"
+        f"#ARTIST:Artist {rng.randrange(1000)};\n"
+        f"#BPMS:{generate_bpms(rng, bpm_changes)};\n"
+        f"#OFFSET:-0.010;\n"
+    )
+    for difficulty in rng.sample(["Beginner", "Easy", "Medium", "Hard", "Challenge", "Edit"], rng.randint(1, 6)):
+        stepstype = rng.choice(["dance-single", "dance-single", "dance-double", "pump-single"])
+        panels = 8 if stepstype == "dance-double" else 5 if stepstype == "pump-single" else 4
+        measures = ",\n// measure\n".join(
+            generate_measure(rng, rng.choice(config.densities), panels) for _ in range(config.measures)
+        )
+        text += f"#NOTES:\n     {stepstype}:\n     :\n     {difficulty}:\n     {rng.randint(1, 20)}:\n"
+        text += f"     0,0,0,0,0:\n{measures}\n;\n"
+
+    encoding = "utf-8"
+    if rng.random() < config.odd_encoding_ratio:
+        odd = rng.choice(["cp1252", "cp932", "bom", "crlf"])
+        if odd == "cp1252":
+            text, encoding = text.replace(title, f"{title} Café"), "cp1252"
+        elif odd == "cp932":
+            text, encoding = text.replace(title, f"{title} 日本"), "cp932"
+        elif odd == "bom":
+            text = "﻿" + text
+        else:
+            text = text.replace("\n", "\r\n")
+
+    data = text.encode(encoding)
+    if rng.random() < config.malformed_ratio:
+        broken = rng.choice(["stray", "garbage", "missing_semicolon"])
+        if broken == "stray":
+            data = data.replace(b";\n#ARTIST", b";\nstray text\n#ARTIST")
+        elif broken == "garbage":
+            data = data.replace(b"#SUBTITLE:;", b"#SUBTITLE:\x81\xff\xfe\x8d;")
+        else:
+            data = data.replace(b";\n#OFFSET", b"\n#OFFSET")
+
+    return data
+
+
+def generate_corpus(root: Path, config: CorpusConfig) -> list[Path]:
+    """Writes `<root>/<pack>/<song>/song.sm` files, some of which are byte-identical copies of songs from other packs."""
+    rng = random.Random(config.seed)
+    paths = []
+    unique = []
+
+    for i in range(config.simfiles):
+        pack = f"Pack {i % config.packs:03d}"
+        song_dir = root / pack / f"Song {i:06d}"
+        song_dir.mkdir(parents=True, exist_ok=True)
+
+        if unique and rng.random() < config.duplicate_ratio:
+            data = rng.choice(unique)
+        else:
+            data = generate_simfile(rng, config, f"Song {i}")
+            unique.append(data)
+
+        path = song_dir / "song.sm"
+        path.write_bytes(data)
+        paths.append(path)
+
+    return paths
+
+
+def measure(fn, repeat: int = 3) -> float:
+    """Best wall time of `repeat` runs."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def result(seconds: float, count: int) -> dict:
+    return {"seconds": seconds, "count": count, "us_per_item": seconds / count * 1e6 if count else None}
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            yield
+
+
+def run_main(argv: list[str]):
+    saved_argv = sys.argv
+    sys.argv = ["sm-db-gen", *argv]
+    try:
+        with quiet():
+            gen.main()
+    finally:
+        sys.argv = saved_argv
+
+
+def bench(corpus: Path, paths: list[Path], workdir: Path, workers: int, repeat: int) -> dict:
+    results = {}
+    raw = {p: p.read_bytes() for p in paths}
+
+    with quiet():
+        sims = [(p, gen.load_simfile(p, data)) for p, data in raw.items()]
+    sims = [(p, sim) for p, sim in sims if sim is not None]
+    charts = [(p, sim, chart) for p, sim in sims for chart in sim.charts if chart.notes]
+    measures = [m for _, _, chart in charts for m in chart.notes.split(",") if m.strip()]
+    bpms = [sim.bpms.replace("\n", "") for _, sim in sims if sim.bpms]
+
+    results["minimize_measure"] = result(
+        measure(lambda: [gen.minimize_measure(m) for m in measures], repeat), len(measures)
+    )
+    results["normalize_bpms"] = result(measure(lambda: [gen.normalize_bpms(b) for b in bpms], repeat), len(bpms))
+
+    def process_charts():
+        with quiet():
+            for p, sim, chart in charts:
+                gen.process_chart(sim, chart, p)
+
+    results["process_chart"] = result(measure(process_charts, repeat), len(charts))
+
+    def load_simfiles():
+        with quiet():
+            for p, data in raw.items():
+                gen.load_simfile(p, data)
+
+    results["load_simfile"] = result(measure(load_simfiles, repeat), len(raw))
+
+    def hash_simfiles():
+        with quiet():
+            for p, data in raw.items():
+                gen.chart_hashes(p, data)
+
+    results["chart_hashes"] = result(measure(hash_simfiles, repeat), len(raw))
+
+    for executor in gen.EXECUTORS:
+        db = workdir / f"main_{executor}"
+
+        def generate():
+            shutil.rmtree(db, ignore_errors=True)
+            run_main(["--executor", executor, "--workers", str(workers), "--db", str(db), str(corpus)])
+
+        results[f"main[{executor}]"] = result(measure(generate, repeat), len(paths))
+
+    # storage drivers are benchmarked with charts produced by a regular run
+    mismatches = Counter()
+    with quiet():
+        songs = [gen.analyze_sim(p, None, mismatches)[0] for p in paths]
+    songs = [song for song in songs if song]
+    num_charts = len({c.hash for song in songs for c in song})
+
+    for name, driver in STORAGE_DRIVERS.items():
+        db = workdir / f"storage_{name}"
+
+        def to_disk():
+            shutil.rmtree(db, ignore_errors=True)
+            storage = SQLiteStorage.create(db) if driver is SQLiteStorage else driver()
+            for song in songs:
+                storage.add_song([c.copy() for c in song])
+            with quiet():
+                storage.to_disk(db)
+
+        results[f"to_disk[{name}]"] = result(measure(to_disk, repeat), num_charts)
+        results[f"from_disk[{name}]"] = result(measure(lambda: driver.from_disk(db), repeat), num_charts)
+
+    return results
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--simfiles", type=int, default=1000, help="Number of simfiles in the corpus")
+    parser.add_argument("--packs", type=int, default=20, help="Number of packs the simfiles are spread over")
+    parser.add_argument(
+        "--densities", type=int, nargs="+", default=[4, 8, 16, 48, 192], help="Possible numbers of rows per measure"
+    )
+    parser.add_argument("--measures", type=int, default=64, help="Number of measures per chart")
+    parser.add_argument("--bpm-changes", type=int, default=8, help="Maximum number of BPM changes per simfile")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.2, help="Share of byte-identical copies")
+    parser.add_argument("--malformed-ratio", type=float, default=0.05, help="Share of malformed simfiles")
+    parser.add_argument(
+        "--odd-encoding-ratio", type=float, default=0.1, help="Share of non-utf-8, BOM or CRLF simfiles"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus generator")
+    parser.add_argument("--workers", "-j", type=int, default=len(os.sched_getaffinity(0)), help="Workers for main")
+    parser.add_argument("--repeat", type=int, default=3, help="Best time of this many runs is reported")
+    parser.add_argument("--corpus", type=Path, help="Keep the generated corpus in this directory, it has to be empty")
+    parser.add_argument("--output", type=Path, help="Write results to this file instead of stdout")
+
+    return parser
+
+
+def main():
+    parser = _get_parser()
+    args = parser.parse_args()
+    if args.corpus and args.corpus.exists() and any(args.corpus.iterdir()):
+        parser.error(f"{args.corpus} is not empty")
+    config = CorpusConfig(
+        simfiles=args.simfiles,
+        packs=args.packs,
+        densities=args.densities,
+        measures=args.measures,
+        bpm_changes=args.bpm_changes,
+        duplicate_ratio=args.duplicate_ratio,
+        malformed_ratio=args.malformed_ratio,
+        odd_encoding_ratio=args.odd_encoding_ratio,
+        seed=args.seed,
+    )
+
+    with tempfile.TemporaryDirectory(prefix="sm-db-bench-") as workdir:
+        workdir = Path(workdir)
+        corpus = args.corpus or workdir / "corpus"
+        paths = generate_corpus(corpus, config)
+
+        results = bench(corpus, paths, workdir, args.workers, args.repeat)
+
+    report = json.dumps(
+        {
+            "version": importlib.metadata.version("stepmania-chart-db-generator"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+            "workers": args.workers,
+            "corpus": config.to_dict(),
+            "results": results,
+        },
+        indent=2,
+    )
+
+    if args.output:
+        args.output.write_text(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import threading
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe cache of the `size` most recently used items. Values can be `None`, so missing keys are told apart
+    by the `MISSING` default."""
+
+    def __init__(self, size: int):
+        self._size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            value = self._items.get(key, MISSING)
+            if value is MISSING:
+                return default
+
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self._size <= 0:
+            return
+
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -0,0 +1,259 @@
+import argparse
+import datetime
+import io
+import json
+import os
+import re
+import shutil
+import tarfile
+from collections.abc import Iterable
+from pathlib import Path
+
+from sm_db_gen.db import Chart
+from sm_db_gen.search import SearchIndex
+from sm_db_gen.writer import DEFAULT_WRITERS, get_chart_path, prepare_db_dirs, run_by_shard, run_parallel
+
+CHANGESET_VERSION = 1
+CHANGESET_MEMBER = "changeset.json"
+HASH_PATTERN = re.compile(r"[0-9a-f]{16}")
+
+
+class ChangesetError(Exception):
+    pass
+
+
+def get_changeset_name(last_update: str) -> str:
+    """Names sort in the order of db versions, e.g. `changeset-20241016T115812602603Z.tar.gz`."""
+    timestamp = datetime.datetime.fromisoformat(last_update).astimezone(datetime.timezone.utc)
+    return f"changeset-{timestamp:%Y%m%dT%H%M%S%fZ}.tar.gz"
+
+
+class Changeset:
+    """Collects files of the json tree db changed by saves of a storage driver and writes them as a delta archive
+    after each save, so that downstream copies of the db can be updated with just the changes. An archive contains:
+      changeset.json   format version, `last_update` of the db it applies to (`base`) and of the db it produces,
+                       lists of changed and removed charts and packs
+      charts/...       added or modified chart files
+      packs/...        added or modified pack files
+      metadata.json
+    """
+
+    def __init__(self, directory: Path, base: str | None):
+        self.directory = directory
+        self.base = base
+        self.charts = set()
+        self.packs = set()
+        self.removed_charts = set()
+        self.removed_packs = set()
+
+    def __bool__(self):
+        return bool(self.charts or self.packs or self.removed_charts or self.removed_packs)
+
+    def update(
+        self,
+        charts: Iterable[str] = (),
+        packs: Iterable[str] = (),
+        removed_charts: Iterable[str] = (),
+        removed_packs: Iterable[str] = (),
+    ):
+        """Files that are removed and added again within a single changeset are just modified."""
+        removed_charts, removed_packs = set(removed_charts), set(removed_packs)
+        self.charts.difference_update(removed_charts)
+        self.packs.difference_update(removed_packs)
+        self.removed_charts.update(removed_charts)
+        self.removed_packs.update(removed_packs)
+
+        self.charts.update(charts)
+        self.packs.update(packs)
+        self.removed_charts.difference_update(self.charts)
+        self.removed_packs.difference_update(self.packs)
+
+    def to_disk(self, db_path: Path, last_update: str) -> Path | None:
+        """Has to be called once the save is complete, files are read back from the db. Nothing is written if nothing
+        has changed since the previous changeset."""
+        if not self:
+            return None
+
+        changeset = {
+            "version": CHANGESET_VERSION,
+            "base": self.base,
+            "last_update": last_update,
+            "charts": sorted(self.charts),
+            "packs": sorted(self.packs),
+            "removed_charts": sorted(self.removed_charts),
+            "removed_packs": sorted(self.removed_packs),
+        }
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        archive_path = self.directory / get_changeset_name(last_update)
+        tmp_path = archive_path.with_name(f".{archive_path.name}.tmp")
+        with tarfile.open(tmp_path, "w:gz") as archive:
+            _add_member(archive, CHANGESET_MEMBER, json.dumps(changeset, indent=2).encode())
+            for hash_v3 in changeset["charts"]:
+                name = get_chart_path(Path("charts"), hash_v3)
+                archive.add(db_path / name, arcname=name.as_posix())
+            for pack in changeset["packs"]:
+                archive.add(db_path / "packs" / f"{pack}.json", arcname=f"packs/{pack}.json")
+            archive.add(db_path / "metadata.json", arcname="metadata.json")
+        os.replace(tmp_path, archive_path)
+
+        print(f"Saved changeset {archive_path}")
+
+        self.base = last_update
+        self.charts.clear()
+        self.packs.clear()
+        self.removed_charts.clear()
+        self.removed_packs.clear()
+
+        return archive_path
+
+
+def _add_member(archive: tarfile.TarFile, name: str, content: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    archive.addfile(info, io.BytesIO(content))
+
+
+def _read_member(archive: tarfile.TarFile, name: str) -> bytes:
+    try:
+        member = archive.extractfile(name)
+    except KeyError:
+        member = None
+    if member is None:
+        raise ChangesetError(f"{name} is missing in the changeset")
+
+    return member.read()
+
+
+def _validate(changeset: dict):
+    if changeset.get("version") != CHANGESET_VERSION:
+        raise ChangesetError(f"Unsupported changeset version {changeset.get('version')}")
+
+    for hash_v3 in changeset["charts"] + changeset["removed_charts"]:
+        if not HASH_PATTERN.fullmatch(hash_v3):
+            raise ChangesetError(f"Invalid chart hash {hash_v3!r}")
+
+    for pack in changeset["packs"] + changeset["removed_packs"]:
+        if not pack or "/" in pack or "\0" in pack or pack in (".", ".."):
+            raise ChangesetError(f"Invalid pack name {pack!r}")
+
+
+def _read_chart(path: Path) -> Chart | None:
+    try:
+        return Chart(**json.loads(path.read_text()))
+    except IOError:
+        return None
+
+
+def apply_changeset(archive_path: Path, db_path: Path, force: bool = False, writers: int = DEFAULT_WRITERS) -> dict:
+    """Applies the changeset to a downstream copy of the db. The copy has to be at the `base` version of the
+    changeset unless `force` is set. All the files are extracted to a staging directory first and moved to their
+    places afterwards, `metadata.json` goes last, so an interrupted apply leaves the copy at the `base` version and
+    can simply be run again. The search index of the copy is updated too, other bookkeeping files are rebuilt by the
+    drivers once they notice that they're stale."""
+    staging_dir = db_path / ".changeset"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    staging_dir.mkdir(parents=True)
+
+    try:
+        with tarfile.open(archive_path, "r:*") as archive:
+            changeset = json.loads(_read_member(archive, CHANGESET_MEMBER))
+            _validate(changeset)
+
+            current = (
+                json.loads((db_path / "metadata.json").read_text()) if (db_path / "metadata.json").exists() else {}
+            )
+            if current.get("last_update") != changeset["base"] and not force:
+                raise ChangesetError(
+                    f"{archive_path} applies to the db from {changeset['base']}, but {db_path} is from "
+                    f"{current.get('last_update')}"
+                )
+
+            names = [get_chart_path(Path("charts"), hash_v3) for hash_v3 in changeset["charts"]]
+            names += [Path("packs") / f"{pack}.json" for pack in changeset["packs"]]
+            names.append(Path("metadata.json"))
+            for name in names:
+                staged_path = staging_dir / name
+                staged_path.parent.mkdir(parents=True, exist_ok=True)
+                staged_path.write_bytes(_read_member(archive, name.as_posix()))
+
+        packs_dir, charts_dir = prepare_db_dirs(db_path)
+        staged_charts_dir = staging_dir / "charts"
+
+        # charts that didn't exist and charts that are going away, as they were, for the search index
+        added = [hash_v3 for hash_v3 in changeset["charts"] if not get_chart_path(charts_dir, hash_v3).exists()]
+        added = [_read_chart(get_chart_path(staged_charts_dir, hash_v3)) for hash_v3 in added]
+        removed = run_by_shard(
+            lambda hash_v3: _read_chart(get_chart_path(charts_dir, hash_v3)), changeset["removed_charts"], writers
+        )
+
+        # the same order as in saves: charts, packs, removals, indexes and metadata.json
+        run_by_shard(
+            lambda hash_v3: os.replace(get_chart_path(staged_charts_dir, hash_v3), get_chart_path(charts_dir, hash_v3)),
+            changeset["charts"],
+            writers,
+        )
+        run_parallel(
+            lambda pack: os.replace(staging_dir / "packs" / f"{pack}.json", packs_dir / f"{pack}.json"),
+            changeset["packs"],
+            writers,
+        )
+        run_parallel(lambda pack: (packs_dir / f"{pack}.json").unlink(missing_ok=True), changeset["removed_packs"])
+        run_by_shard(
+            lambda hash_v3: get_chart_path(charts_dir, hash_v3).unlink(missing_ok=True),
+            changeset["removed_charts"],
+            writers,
+        )
+
+        def all_charts():
+            return filter(None, map(_read_chart, charts_dir.glob("*/*.json")))
+
+        SearchIndex(db_path).to_disk(
+            [chart for chart in added if chart is not None],
+            [chart for chart in removed if chart is not None],
+            changeset["last_update"],
+            all_charts,
+            writers,
+        )
+
+        os.replace(staging_dir / "metadata.json", db_path / "metadata.json")
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    return changeset
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="Applies changesets saved by `sm-db-gen --changesets` to a downstream copy of the db, in the given "
+        "order",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("changesets", type=Path, nargs="+", help="Changeset archive(s)", metavar="CHANGESET")
+    parser.add_argument("--db", type=Path, default=Path("db_v2"), help="Path to the db directory")
+    parser.add_argument(
+        "--force", action="store_true", help="Apply changesets even if they were made for another version of the db"
+    )
+    parser.add_argument("--writers", type=int, default=DEFAULT_WRITERS, help="Number of threads used to save the db")
+
+    return parser
+
+
+def main():
+    parser = _get_parser()
+    args = parser.parse_args()
+
+    for archive_path in args.changesets:
+        try:
+            changeset = apply_changeset(archive_path, args.db, args.force, args.writers)
+        except (ChangesetError, tarfile.TarError) as e:
+            parser.exit(1, f"Can't apply {archive_path}: {e}\n")
+
+        print(
+            f"Applied {archive_path}: {len(changeset['charts'])} charts and {len(changeset['packs'])} packs saved, "
+            f"{len(changeset['removed_charts'])} charts and {len(changeset['removed_packs'])} packs removed"
+        )
+
+
+if __name__ == "__main__":
+    main()
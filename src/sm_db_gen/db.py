@@ -1,9 +1,28 @@
 import datetime
 import json
+import sqlite3
+import sys
+from array import array
 from collections import defaultdict
-from contextlib import suppress
+from collections.abc import Iterator
+from contextlib import closing, suppress
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
 
+from sm_db_gen.index import HashIndex
+from sm_db_gen.search import SearchIndex, chart_search_keys
+from sm_db_gen.writer import (
+    CHART_SHARDS,
+    DEFAULT_WRITERS,
+    get_chart_path,
+    prepare_db_dirs,
+    run_by_shard,
+    run_parallel,
+    write_atomic,
+)
+
 
 class SetEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -37,6 +56,12 @@ class Chart:
                 v = set(v)
             setattr(self, k, v)
 
+    def copy(self, **kwargs) -> "Chart":
+        attributes = {k: getattr(self, k) for k in self.__slots__ if hasattr(self, k)}
+        attributes.update(kwargs)
+
+        return Chart(**attributes)
+
     def to_json(self):
         return json.dumps(
             {k: getattr(self, k) for k in self.__slots__},
@@ -46,15 +71,37 @@ class Chart:
 
 
 class StorageV2:
+    changeset = None  # `Changeset` that collects files changed by saves, if delta archives are requested
+
     def get_chart(self, hash_v3: str) -> Chart | None:
         raise NotImplementedError
 
     def add_song(self, charts: list[Chart]):
         raise NotImplementedError
 
+    def add_chart(self, chart: Chart):
+        """Adds a chart that already carries all of its packs and diffs, e.g. one merged from other storage."""
+        raise NotImplementedError
+
     def get_charts(self, pack: str):
         raise NotImplementedError
 
+    def remove_pack(self, pack: str, writers: int = DEFAULT_WRITERS) -> tuple[int, int]:
+        """Removes the pack from all of its charts, which are found through the pack file, and removes charts that no
+        longer belong to any pack. Returns the number of updated and removed charts."""
+        raise NotImplementedError
+
+    def search(
+        self,
+        title: str | None = None,
+        artist: str | None = None,
+        steps_type: str | None = None,
+        diff: str | None = None,
+        diff_number: int | None = None,
+    ) -> list[str]:
+        """Returns sorted hashes of saved charts that match all the given criteria, see `SearchIndex.search`."""
+        raise NotImplementedError
+
     @property
     def num_charts(self) -> int:
         raise NotImplementedError
@@ -67,130 +114,439 @@ class StorageV2:
     def last_update(self) -> datetime.datetime:
         raise NotImplementedError
 
+    @classmethod
+    def read_last_update(cls, path: Path) -> str | None:
+        """Reads `last_update` of the db as it's currently saved, which tells whether the db has been changed, e.g. by
+        another process, since it was loaded."""
+        try:
+            return json.loads((path / "metadata.json").read_text())["last_update"]
+        except (IOError, ValueError, KeyError):
+            return None
+
+
+def remove_pack_from_charts(pack: str, charts: list[Chart]) -> tuple[list[Chart], set[str]]:
+    """Drops the pack from charts of the pack. Returns charts that still belong to other packs and hashes of the ones
+    that don't, which are dropped from diffs of the remaining charts too. Diffs of charts from other packs don't need
+    any changes, only charts of the same song could have been siblings of the removed ones."""
+    removed = {chart.hash for chart in charts if chart.packs <= {pack}}
+
+    kept = []
+    for chart in charts:
+        if chart.hash in removed:
+            continue
+
+        chart.packs.discard(pack)
+        chart.diffs.difference_update(removed)
+        if chart.pack_name == pack:
+            chart.pack_name = min(chart.packs)
+        kept.append(chart)
+
+    return kept, removed
+
+
+def _members(value) -> tuple:
+    """Memberships of a chart in packs or sibling groups are kept as a bare id when there's just one of them."""
+    return value if isinstance(value, tuple) else (value,)
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
 
 class InMemStorage(StorageV2):
+    """Keeps the whole db in memory in a compact form and creates `Chart` objects only on demand:
+    - strings are interned and the fields shared by all charts of a song are kept in a single tuple,
+    - packs are referred to by small integer ids, every pack keeps an array of indices of its charts,
+    - instead of its own `diffs` set, every chart refers to the groups of sibling charts it was added with,
+      its diffs are the union of these groups.
+    """
+
+    SONG_FIELDS = ("title", "titletranslit", "artist", "artisttranslit", "subtitle", "subtitletranslit")
+    SNAPSHOT_FILENAME = "snapshot.json"
+    SNAPSHOT_VERSION = 1
+
     def __init__(self):
-        self._packs = defaultdict(set)
-        self._charts = {}
+        self._hashes = []  # chart index -> hash
+        self._index = {}  # hash -> chart index
+        self._records = []  # chart index -> (song fields, steps_type, diff, diff_number, pack id of pack_name)
+        self._chart_packs = []  # chart index -> pack id or a tuple of them
+        self._chart_groups = []  # chart index -> group id or a tuple of them
+        self._songs = {}  # interned song fields
+        self._groups = []  # group id -> sorted tuple of sibling hashes
+        self._group_ids = {}
+        self._pack_names = []  # pack id -> pack name
+        self._pack_ids = {}
+        self._pack_charts = []  # pack id -> array of chart indices
+
         self._last_update = datetime.datetime.now(tz=datetime.timezone.utc)
         self._touched_charts = set()
         self._touched_packs = set()
+        self._removed_charts = set()
+        self._removed_packs = set()
+        self._removed_search_charts = []  # removed charts, their keys are dropped from the search index on save
+        self._location = None
 
     @property
     def num_charts(self) -> int:
-        return len(self._charts)
+        return len(self._index)
 
     @property
     def num_packs(self) -> int:
-        return len(self._packs)
+        return len(self._pack_ids)
 
     @property
     def last_update(self) -> datetime.datetime:
         return self._last_update
 
     @classmethod
-    def from_disk(cls, path: Path) -> "InMemStorage":
-        storage = cls()
-
+    def from_disk(cls, path: Path, writers: int = DEFAULT_WRITERS) -> "InMemStorage":
+        """Loads the snapshot saved by `to_disk` when it matches `metadata.json`. Otherwise, e.g. when the db has been
+        extended with other drivers since, all the files are loaded by `writers` threads, a chart shard each."""
         metadata = json.loads((path / "metadata.json").read_text())
-        storage._last_update = datetime.datetime.fromisoformat(metadata["last_update"])
 
-        for pack_file in (path / "packs").glob("*.json"):
-            charts = json.loads(pack_file.read_text())
-            storage._packs[pack_file.stem].update(charts)
-
-        for chart_file in (path / "charts").rglob("*.json"):
-            chart = Chart(**json.loads(chart_file.read_text()))
-            storage._charts[chart.hash] = chart
+        storage = cls._from_snapshot(path / cls.SNAPSHOT_FILENAME, metadata)
+        if storage is None:
+            print("Snapshot is missing or stale, loading all the files")
+            storage = cls._from_files(path, writers)
+        storage._last_update = datetime.datetime.fromisoformat(metadata["last_update"])
+        storage._location = path
 
-        if metadata["num_charts"] != len(storage._charts):
+        if metadata["num_charts"] != storage.num_charts:
             raise ValueError(
-                f"Inconsistent number of charts! Loaded {len(storage._charts)} from disk, but expected {metadata['num_charts']}"
+                f"Inconsistent number of charts! Loaded {storage.num_charts} from disk, but expected {metadata['num_charts']}"
             )
 
-        if metadata["num_packs"] != len(storage._packs):
+        if metadata["num_packs"] != storage.num_packs:
             raise ValueError(
-                f"Inconsistent number of packs! Loaded {len(storage._packs)} from disk, but expected {metadata['num_packs']}"
+                f"Inconsistent number of packs! Loaded {storage.num_packs} from disk, but expected {metadata['num_packs']}"
             )
 
         return storage
 
-    def to_disk(self, path: Path):
-        packs_dir = path / "packs"
-        packs_dir.mkdir(exist_ok=True, parents=True)
+    @classmethod
+    def _from_files(cls, path: Path, writers: int) -> "InMemStorage":
+        storage = cls()
 
-        charts_dir = path / "charts"
-        charts_dir.mkdir(exist_ok=True, parents=True)
+        def load_shard(shard):
+            shard_dir = path / "charts" / shard
+            if not shard_dir.is_dir():
+                return []
+            return [json.loads(chart_file.read_bytes()) for chart_file in sorted(shard_dir.glob("*.json"))]
+
+        for charts in run_parallel(load_shard, CHART_SHARDS, writers):
+            for chart in charts:
+                storage._add_chart(Chart(**chart))
+
+        pack_files = sorted((path / "packs").glob("*.json"))
+        for pack_file, hashes in zip(
+            pack_files, run_parallel(lambda f: json.loads(f.read_bytes()), pack_files, writers)
+        ):
+            pack_id = storage._get_pack_id(pack_file.stem)
+            for hash in hashes:
+                if hash in storage._index:
+                    storage._link_pack(storage._index[hash], pack_id)
 
-        print(f"Saving {len(self._touched_packs)}/{self.num_packs} packs")
-        for pack in self._touched_packs:
-            charts = self._packs[pack]
-            (packs_dir / f"{pack}.json").write_text(json.dumps(list(charts), sort_keys=True))
+        return storage
+
+    @classmethod
+    def _from_snapshot(cls, snapshot_path: Path, metadata: dict) -> "InMemStorage | None":
+        try:
+            snapshot = json.loads(snapshot_path.read_bytes())
+        except (IOError, ValueError):
+            return None
+
+        if snapshot.get("version") != cls.SNAPSHOT_VERSION or any(
+            snapshot.get(k) != metadata[k] for k in ("last_update", "num_charts", "num_packs")
+        ):
+            return None
+
+        storage = cls()
+        storage._pack_names = [sys.intern(pack) if pack is not None else None for pack in snapshot["packs"]]
+        storage._pack_ids = {pack: pack_id for pack_id, pack in enumerate(storage._pack_names) if pack is not None}
+        storage._pack_charts = [array("I") for _ in storage._pack_names]
+        songs = [tuple(_intern(v) for v in song) for song in snapshot["songs"]]
+        storage._songs = {song: song for song in songs}
+        storage._groups = [tuple(sys.intern(hash) for hash in group) for group in snapshot["groups"]]
+        storage._group_ids = {group: group_id for group_id, group in enumerate(storage._groups)}
+
+        for i, (hash, song, steps_type, diff, diff_number, pack_id, packs, groups) in enumerate(snapshot["charts"]):
+            hash = sys.intern(hash)
+            storage._index[hash] = i
+            storage._hashes.append(hash)
+            storage._records.append((songs[song], _intern(steps_type), _intern(diff), _intern(diff_number), pack_id))
+            storage._chart_packs.append(tuple(packs) if isinstance(packs, list) else packs)
+            storage._chart_groups.append(tuple(groups) if isinstance(groups, list) else groups)
+            for pack in _members(storage._chart_packs[i]):
+                storage._pack_charts[pack].append(i)
 
+        return storage
+
+    def _to_snapshot(self) -> str:
+        song_ids = {song: song_id for song_id, song in enumerate(self._songs)}
+        charts = [
+            [hash, song_ids[record[0]], *record[1:], packs, groups]
+            for hash, record, packs, groups in zip(self._hashes, self._records, self._chart_packs, self._chart_groups)
+            if record is not None  # removed chart
+        ]
+
+        return json.dumps(
+            {
+                "version": self.SNAPSHOT_VERSION,
+                "last_update": self._last_update.isoformat(),
+                "num_charts": self.num_charts,
+                "num_packs": self.num_packs,
+                "packs": self._pack_names,
+                "songs": list(self._songs),
+                "groups": self._groups,
+                "charts": charts,
+            },
+            separators=(",", ":"),
+        )
+
+    def to_disk(self, path: Path, writers: int = DEFAULT_WRITERS):
+        packs_dir, charts_dir = prepare_db_dirs(path)
+
+        # charts go first, so that packs never reference charts that haven't been saved yet
         print(f"Saving {len(self._touched_charts)}/{self.num_charts} charts")
-        for hash in self._touched_charts:
-            chart = self._charts[hash]
-            chart_subdir = charts_dir / f"{hash[:2]}"
-            chart_subdir.mkdir(exist_ok=True, parents=True)
 
-            (chart_subdir / f"{hash[2:]}.json").write_text(chart.to_json())
+        def save_chart(hash):
+            write_atomic(get_chart_path(charts_dir, hash), self.get_chart(hash).to_json())
+
+        run_by_shard(save_chart, self._touched_charts, writers)
+
+        if self._removed_packs or self._removed_charts:
+            print(f"Removing {len(self._removed_packs)} packs and {len(self._removed_charts)} charts")
+            run_parallel(
+                lambda pack: (packs_dir / f"{pack}.json").unlink(missing_ok=True), self._removed_packs, writers
+            )
+            run_by_shard(
+                lambda hash: get_chart_path(charts_dir, hash).unlink(missing_ok=True), self._removed_charts, writers
+            )
+
+        print(f"Saving {len(self._touched_packs)}/{self.num_packs} packs")
+
+        def save_pack(pack):
+            hashes = sorted(self._hashes[i] for i in self._pack_charts[self._pack_ids[pack]])
+            write_atomic(packs_dir / f"{pack}.json", json.dumps(hashes))
+
+        run_parallel(save_pack, self._touched_packs, writers)
 
-        (path / "metadata.json").write_text(
+        # keys of charts don't change once they're saved, so touched charts that aren't new are no-ops
+        print("Saving search index")
+        SearchIndex(path).to_disk(
+            (self.get_chart(hash) for hash in self._touched_charts),
+            self._removed_search_charts,
+            self._last_update.isoformat(),
+            lambda: (self.get_chart(hash) for hash in self._index),
+            writers,
+        )
+
+        # the snapshot is valid only if it matches metadata.json, so an interrupted save makes it stale
+        print("Saving snapshot")
+        write_atomic(path / self.SNAPSHOT_FILENAME, self._to_snapshot())
+
+        write_atomic(
+            path / "metadata.json",
             json.dumps(
                 {
                     "last_update": self._last_update.isoformat(),
-                    "num_charts": len(self._charts),
-                    "num_packs": len(self._packs),
+                    "num_charts": self.num_charts,
+                    "num_packs": self.num_packs,
                 },
                 sort_keys=True,
                 indent=2,
-            )
+            ),
         )
 
+        if self.changeset is not None:
+            self.changeset.update(self._touched_charts, self._touched_packs, self._removed_charts, self._removed_packs)
+            self.changeset.to_disk(path, self._last_update.isoformat())
+
+        self._touched_charts.clear()
+        self._touched_packs.clear()
+        self._removed_charts.clear()
+        self._removed_packs.clear()
+        self._removed_search_charts.clear()
+        self._location = path
+
+    def search(self, **criteria) -> list[str]:
+        return SearchIndex(self._location).search(**criteria) if self._location else []
+
     def get_chart(self, hash_v3: str) -> Chart | None:
-        return self._charts.get(hash_v3)
+        i = self._index.get(hash_v3)
+        if i is None:
+            return None
+
+        song, steps_type, diff, diff_number, pack_id = self._records[i]
+
+        return Chart(
+            **dict(zip(self.SONG_FIELDS, song)),
+            steps_type=steps_type,
+            diff=diff,
+            diff_number=diff_number,
+            pack_name=self._pack_names[pack_id],
+            hash=self._hashes[i],
+            packs={self._pack_names[pack_id] for pack_id in _members(self._chart_packs[i])},
+            diffs={hash for group_id in _members(self._chart_groups[i]) for hash in self._groups[group_id]},
+        )
+
+    def _get_pack_id(self, pack: str) -> int:
+        pack_id = self._pack_ids.get(pack)
+        if pack_id is None:
+            pack_id = self._pack_ids[pack] = len(self._pack_names)
+            self._pack_names.append(sys.intern(pack))
+            self._pack_charts.append(array("I"))
+            self._removed_packs.discard(pack)
+
+        return pack_id
+
+    def _get_group_id(self, hashes) -> int:
+        group = tuple(sorted({sys.intern(hash) for hash in hashes}))
+        group_id = self._group_ids.get(group)
+        if group_id is None:
+            group_id = self._group_ids[group] = len(self._groups)
+            self._groups.append(group)
+
+        return group_id
+
+    def _get_chart_index(self, chart: Chart) -> int:
+        """Returns the index of an already known chart or adds the chart without any packs and groups."""
+        i = self._index.get(chart.hash)
+        if i is not None:
+            return i
+
+        song = tuple(_intern(getattr(chart, k, None)) for k in self.SONG_FIELDS)
+        song = self._songs.setdefault(song, song)
+
+        i = self._index[chart.hash] = len(self._hashes)
+        self._hashes.append(sys.intern(chart.hash))
+        self._removed_charts.discard(chart.hash)
+        self._records.append(
+            (
+                song,
+                _intern(chart.steps_type),
+                _intern(chart.diff),
+                _intern(chart.diff_number),
+                self._get_pack_id(chart.pack_name),
+            )
+        )
+        self._chart_packs.append(())
+        self._chart_groups.append(())
+
+        return i
+
+    def _link_pack(self, i: int, pack_id: int):
+        packs = _members(self._chart_packs[i])
+        if pack_id in packs:
+            return
+
+        self._chart_packs[i] = packs + (pack_id,) if packs else pack_id
+        self._pack_charts[pack_id].append(i)
+
+    def _link_group(self, i: int, group_id: int):
+        groups = _members(self._chart_groups[i])
+        if group_id not in groups:
+            self._chart_groups[i] = groups + (group_id,) if groups else group_id
+
+    def _add_chart(self, chart: Chart):
+        i = self._get_chart_index(chart)
+        for pack in chart.packs:
+            self._link_pack(i, self._get_pack_id(pack))
+        self._link_group(i, self._get_group_id(chart.diffs))
 
     def add_song(self, charts: list[Chart]):
         self._last_update = datetime.datetime.now(tz=datetime.timezone.utc)
 
-        diffs = {c.hash for c in charts}
-        self._touched_charts.update(diffs)
+        indices = [self._get_chart_index(chart) for chart in charts]
+        group_id = self._get_group_id(c.hash for c in charts)
 
-        for chart in charts:
-            chart.diffs = diffs
-            hash = chart.hash
-            pack_name = chart.pack_name
-            self._touched_packs.add(pack_name)
-            self._packs[pack_name].add(hash)
+        for i, chart in zip(indices, charts):
+            self._touched_charts.add(chart.hash)
+            self._touched_packs.add(chart.pack_name)
+            self._link_pack(i, self._get_pack_id(chart.pack_name))
+            self._link_group(i, group_id)
 
-            if hash in self._charts:
-                self._charts[hash].packs.add(pack_name)
-                self._charts[hash].diffs.update(diffs)
-            else:
-                self._charts[hash] = chart
+    def add_chart(self, chart: Chart):
+        self._last_update = datetime.datetime.now(tz=datetime.timezone.utc)
+
+        self._add_chart(chart)
+        self._touched_charts.add(chart.hash)
+        self._touched_packs.update(chart.packs)
 
     def get_charts(self, pack: str) -> list[Chart]:
-        return [self._charts[hash] for hash in self._packs[pack]]
+        pack_id = self._pack_ids.get(pack)
+        if pack_id is None:
+            return []
+
+        return [self.get_chart(self._hashes[i]) for i in self._pack_charts[pack_id]]
+
+    def remove_pack(self, pack: str, writers: int = DEFAULT_WRITERS) -> tuple[int, int]:
+        """Files are updated and removed by the next `to_disk`. Removed charts and packs leave empty slots behind."""
+        pack_id = self._pack_ids.get(pack)
+        if pack_id is None:
+            return 0, 0
+
+        self._last_update = datetime.datetime.now(tz=datetime.timezone.utc)
+
+        charts = self.get_charts(pack)
+        kept, removed = remove_pack_from_charts(pack, charts)
+        self._removed_search_charts.extend(chart for chart in charts if chart.hash in removed)
+
+        del self._pack_ids[pack]
+        self._pack_names[pack_id] = None
+        self._pack_charts[pack_id] = array("I")
+        self._touched_packs.discard(pack)
+        self._removed_packs.add(pack)
+
+        for hash in removed:
+            i = self._index.pop(hash)
+            self._hashes[i] = self._records[i] = None
+            self._chart_packs[i] = self._chart_groups[i] = ()
+            self._touched_charts.discard(hash)
+            self._removed_charts.add(hash)
+
+        for chart in kept:
+            i = self._index[chart.hash]
+            self._records[i] = (*self._records[i][:-1], self._pack_ids[chart.pack_name])
+            pack_ids = tuple(self._pack_ids[pack] for pack in chart.packs)
+            self._chart_packs[i] = pack_ids if len(pack_ids) > 1 else pack_ids[0]
+            self._chart_groups[i] = self._get_group_id(chart.diffs)
+            self._touched_charts.add(chart.hash)
+
+        return len(kept), len(removed)
+
+
+def _read_chart(charts_dir: Path, hash_v3: str) -> Chart:
+    return Chart(**json.loads(get_chart_path(charts_dir, hash_v3).read_text()))
 
 
 class LazyStorage(StorageV2):
+    """Keeps only the songs added since the last save in memory. Hashes and packs already stored in the db are known
+    from its `HashIndex`, so that neither counting nor saving needs to look for files that don't exist."""
+
     def __init__(self):
         self._packs = defaultdict(set)
         self._charts = {}
-        self._last_update = None
+        self._last_update = datetime.datetime.now(tz=datetime.timezone.utc)
         self._location = None
+        self._index = None
 
         self._num_disk_packs = 0
         self._num_disk_charts = 0
 
-    # these are just a guesstimates until we save
     @property
     def num_charts(self) -> int:
-        return self._num_disk_charts + len(self._charts)
+        if self._index is None:  # just a guesstimate until we save
+            return self._num_disk_charts + len(self._charts)
+
+        return len(self._index) + sum(hash not in self._index for hash in self._charts)
 
     @property
     def num_packs(self) -> int:
-        return self._num_disk_packs + len(self._packs)
+        if self._index is None:  # just a guesstimate until we save
+            return self._num_disk_packs + len(self._packs)
+
+        return len(self._index.packs.union(self._packs))
 
     @property
     def last_update(self):
@@ -206,52 +562,103 @@ class LazyStorage(StorageV2):
         storage._last_update = datetime.datetime.fromisoformat(metadata["last_update"])
         storage._num_disk_charts = metadata["num_charts"]
         storage._num_disk_packs = metadata["num_packs"]
+        storage._index = cls._load_index(path, metadata)
 
         return storage
 
-    def to_disk(self, path: Path):
-        new_packs = 0
-        new_charts = 0
+    @staticmethod
+    def _load_index(path: Path, metadata: dict | None) -> HashIndex:
+        if metadata is None:
+            return HashIndex()
 
-        packs_dir = path / "packs"
-        packs_dir.mkdir(exist_ok=True, parents=True)
+        index = HashIndex.from_disk(path)
+        if index is None or not index.is_valid_for(metadata):
+            # e.g. the db has been created or extended by other drivers
+            print("Hash index is missing or stale, listing the db files")
+            index = HashIndex.from_files(path)
 
-        charts_dir = path / "charts"
-        charts_dir.mkdir(exist_ok=True, parents=True)
+        return index
 
-        print(f"Saving {len(self._packs)} packs")
-        for pack, charts in self._packs.items():
-            new_packs += 1
-            with suppress(IOError):
-                disk_charts = json.loads((packs_dir / f"{pack}.json").read_text())
-                charts.update(disk_charts)
-                new_packs -= 1
+    def to_disk(self, path: Path, writers: int = DEFAULT_WRITERS):
+        if self._index is None or path != self._location:
+            metadata_path = path / "metadata.json"
+            metadata = json.loads(metadata_path.read_text()) if metadata_path.exists() else None
+            self._index = self._load_index(path, metadata)
+            self._location = path
+        index = self._index
 
-            (packs_dir / f"{pack}.json").write_text(json.dumps(list(charts), sort_keys=True))
+        packs_dir, charts_dir = prepare_db_dirs(path)
+        new_hashes = [hash for hash in self._charts if hash not in index]
 
+        # charts go first, so that packs never reference charts that haven't been saved yet
         print(f"Saving {len(self._charts)} charts")
-        for hash, chart in self._charts.items():
-            new_charts += 1
-            chart_subdir = charts_dir / f"{hash[:2]}"
-            chart_subdir.mkdir(exist_ok=True, parents=True)
-            chart_path = chart_subdir / f"{hash[2:]}.json"
-
-            with suppress(IOError):
-                disk_chart = Chart(**json.loads(chart_path.read_text()))
-                # keep original data, only extend packs/diffs
-                disk_chart.packs.update(chart.packs)
-                disk_chart.diffs.update(chart.diffs)
-                chart = disk_chart
-                new_charts -= 1
-
-            chart_path.write_text(chart.to_json())
+
+        def save_chart(hash) -> bool:
+            chart = self._charts[hash]
+            chart_path = get_chart_path(charts_dir, hash)
+            is_new = hash not in index
+
+            if not is_new:
+                with suppress(IOError):
+                    disk_chart = Chart(**json.loads(chart_path.read_text()))
+                    # keep original data, only extend packs/diffs
+                    disk_chart.packs.update(chart.packs)
+                    disk_chart.diffs.update(chart.diffs)
+                    chart = disk_chart
+
+            write_atomic(chart_path, chart.to_json())
+
+            return is_new
+
+        new_charts = sum(run_by_shard(save_chart, self._charts, writers))
+
+        print(f"Saving {len(self._packs)} packs")
+
+        def save_pack(pack) -> bool:
+            charts = self._packs[pack]
+            pack_path = packs_dir / f"{pack}.json"
+            is_new = pack not in index.packs
+
+            if not is_new:
+                with suppress(IOError):
+                    disk_charts = json.loads(pack_path.read_text())
+                    charts.update(disk_charts)
+
+            write_atomic(pack_path, json.dumps(sorted(charts)))
+
+            return is_new
+
+        new_packs = sum(run_parallel(save_pack, self._packs, writers))
 
         print(f"Saved {new_charts} new charts and {new_packs} new packs")
 
-        self._num_disk_packs += new_packs
-        self._num_disk_charts += new_charts
+        # data of charts that already existed is kept, so only new charts get new search keys
+        SearchIndex(path).to_disk(
+            [self._charts[hash] for hash in new_hashes],
+            (),
+            self._last_update.isoformat(),
+            lambda: run_by_shard(partial(_read_chart, charts_dir), [*index, *new_hashes], writers),
+            writers,
+        )
+        self._save_index(path, self._charts, self._packs)
+
+        if self.changeset is not None:
+            self.changeset.update(self._charts, self._packs)
+            self.changeset.to_disk(path, self._last_update.isoformat())
+
+        self._charts.clear()
+        self._packs.clear()
 
-        (path / "metadata.json").write_text(
+    def _save_index(self, path: Path, new_hashes, new_packs, removed_hashes=(), removed_packs=()):
+        # the index goes before metadata.json, so that an interrupted save leaves it stale
+        self._index = self._index.to_disk(
+            path, new_hashes, new_packs, self._last_update.isoformat(), removed_hashes, removed_packs
+        )
+        self._num_disk_packs = len(self._index.packs)
+        self._num_disk_charts = len(self._index)
+
+        write_atomic(
+            path / "metadata.json",
             json.dumps(
                 {
                     "last_update": self._last_update.isoformat(),
@@ -260,17 +667,69 @@ class LazyStorage(StorageV2):
                 },
                 sort_keys=True,
                 indent=2,
-            )
+            ),
         )
 
-        self._charts.clear()
-        self._packs.clear()
+    def remove_pack(self, pack: str, writers: int = DEFAULT_WRITERS) -> tuple[int, int]:
+        """Files are updated and removed right away, so there can't be any pending changes."""
+        if self._charts:
+            raise RuntimeError(f"{len(self._charts)} pending changes, please call to_disk first.")
+
+        if self._index is None or pack not in self._index.packs:
+            return 0, 0
+
+        pack_path = self._location / "packs" / f"{pack}.json"
+        charts_dir = self._location / "charts"
+        charts = [chart for chart in run_by_shard(self.get_chart, json.loads(pack_path.read_text()), writers) if chart]
+        kept, removed = remove_pack_from_charts(pack, charts)
+
+        self._last_update = datetime.datetime.now(tz=datetime.timezone.utc)
+
+        # the same order as in `to_disk`: charts, packs and the index with metadata.json
+        kept = {chart.hash: chart for chart in kept}
+        run_by_shard(lambda hash: write_atomic(get_chart_path(charts_dir, hash), kept[hash].to_json()), kept, writers)
+        pack_path.unlink(missing_ok=True)
+        run_by_shard(lambda hash: get_chart_path(charts_dir, hash).unlink(missing_ok=True), removed, writers)
+        SearchIndex(self._location).to_disk(
+            (),
+            [chart for chart in charts if chart.hash in removed],
+            self._last_update.isoformat(),
+            lambda: run_by_shard(
+                partial(_read_chart, charts_dir), [hash for hash in self._index if hash not in removed], writers
+            ),
+            writers,
+        )
+        self._save_index(self._location, (), (), removed, [pack])
+        if self.changeset is not None:
+            self.changeset.update(kept, (), removed, [pack])
+
+        return len(kept), len(removed)
+
+    def search(self, **criteria) -> list[str]:
+        return SearchIndex(self._location).search(**criteria) if self._location else []
+
+    def get_charts(self, pack: str) -> list[Chart]:
+        if self._charts:
+            raise RuntimeError(f"{len(self._charts)} pending changes, please call to_disk first.")
+
+        if self._index is not None and pack not in self._index.packs:
+            return []
+
+        try:
+            hashes = json.loads((self._location / "packs" / f"{pack}.json").read_text())
+        except IOError:
+            return []
+
+        return [chart for hash in hashes if (chart := self.get_chart(hash)) is not None]
 
     def get_chart(self, hash_v3: str) -> Chart | None:
         if self._charts:
             raise RuntimeError(f"{len(self._charts)} pending changes, please call to_disk first.")
 
-        chart_path = self._location / "charts" / f"{hash_v3[:2]}" / f"{hash_v3[2:]}.json"
+        if self._index is not None and hash_v3 not in self._index:
+            return None
+
+        chart_path = get_chart_path(self._location / "charts", hash_v3)
         try:
             return Chart(**json.loads(chart_path.read_text()))
         except IOError:
@@ -282,7 +741,7 @@ class LazyStorage(StorageV2):
         diffs = {c.hash for c in charts}
 
         for chart in charts:
-            chart.diffs = diffs
+            chart.diffs = set(diffs)
             hash = chart.hash
             pack_name = chart.pack_name
             self._packs[pack_name].add(hash)
@@ -293,8 +752,311 @@ class LazyStorage(StorageV2):
             else:
                 self._charts[hash] = chart
 
+    def add_chart(self, chart: Chart):
+        self._last_update = datetime.datetime.now(tz=datetime.timezone.utc)
+
+        hash = chart.hash
+        for pack_name in chart.packs:
+            self._packs[pack_name].add(hash)
+
+        if hash in self._charts:
+            self._charts[hash].packs.update(chart.packs)
+            self._charts[hash].diffs.update(chart.diffs)
+        else:
+            self._charts[hash] = chart
+
+
+class StorageShard:
+    """Accumulates songs processed by a single worker without any synchronization. Every song comes with its order,
+    e.g. the position of its simfile in the discovery, so that the first occurrence of a chart is the canonical one
+    regardless of which worker processed it and when. Merged shards are saved with `StorageV2.add_chart`."""
+
+    def __init__(self):
+        self._charts = {}  # hash -> (order, chart)
+
+    def __len__(self):
+        return len(self._charts)
+
+    def add_song(self, order, charts: list[Chart]):
+        diffs = {c.hash for c in charts}
+
+        for chart in charts:
+            chart.diffs = set(diffs)
+            self.add_chart(order, chart)
+
+    def add_chart(self, order, chart: Chart):
+        """Adds a chart that already carries all of its packs and diffs, e.g. one from another db."""
+        known = self._charts.get(chart.hash)
+        if known is None:
+            self._charts[chart.hash] = (order, chart)
+            return
+
+        known_order, known_chart = known
+        if order < known_order:
+            known_chart, chart = chart, known_chart
+            self._charts[chart.hash] = (order, known_chart)
+
+        known_chart.packs.update(chart.packs)
+        known_chart.diffs.update(chart.diffs)
+
+    @classmethod
+    def merge(cls, shards: list["StorageShard"]) -> "StorageShard":
+        merged = cls()
+        for shard in shards:
+            for order, chart in shard._charts.values():
+                merged.add_chart(order, chart)
+
+        return merged
+
+    def orders(self) -> dict:
+        """Order of the first occurrence of every chart."""
+        return {hash: order for hash, (order, _) in self._charts.items()}
+
+    def save(self, storage: StorageV2):
+        for _, chart in sorted(self._charts.values(), key=lambda entry: entry[0]):
+            storage.add_chart(chart)
+
+
+class SQLiteStorage(LazyStorage):
+    """Keeps the whole db in a single SQLite file, `<db>/db.sqlite`, instead of a file per chart. Charts are stored as
+    the same json documents as in the files of the json tree, which can be recreated with `export_json` (or
+    `sm-db-export`). Just like with `LazyStorage`, new songs are kept in memory until `to_disk` saves them in a single
+    transaction, so the file is never left half-written."""
+
+    FILENAME = "db.sqlite"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS charts (hash TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS pack_charts (pack TEXT NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (pack, hash))
+            WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS search (
+            field TEXT NOT NULL, key TEXT NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (field, key, hash)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS search_hash ON search (hash);
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._connection = None
+
+    @classmethod
+    def connect(cls, path: Path) -> sqlite3.Connection:
+        path.mkdir(exist_ok=True, parents=True)
+        connection = sqlite3.connect(path / cls.FILENAME, check_same_thread=False)
+        connection.executescript(cls.SCHEMA)
+
+        return connection
+
+    @classmethod
+    def create(cls, path: Path) -> "SQLiteStorage":
+        storage = cls()
+        storage._location = path
+        storage._connection = cls.connect(path)
+
+        return storage
+
+    @classmethod
+    def from_disk(cls, path: Path) -> "SQLiteStorage":
+        storage = cls.create(path)
+        storage._read_metadata()
+
+        return storage
+
+    @classmethod
+    def read_last_update(cls, path: Path) -> str | None:
+        try:
+            with closing(
+                sqlite3.connect((path / cls.FILENAME).absolute().as_uri() + "?mode=ro", uri=True)
+            ) as connection:
+                row = connection.execute("SELECT value FROM metadata WHERE key = 'last_update'").fetchone()
+        except sqlite3.Error:
+            return None
+
+        return row and row[0]
+
+    def _read_metadata(self):
+        metadata = dict(self._connection.execute("SELECT key, value FROM metadata"))
+        if "last_update" in metadata:
+            self._last_update = datetime.datetime.fromisoformat(metadata["last_update"])
+
+        self._num_disk_charts = self._connection.execute("SELECT COUNT(*) FROM charts").fetchone()[0]
+        self._num_disk_packs = self._connection.execute("SELECT COUNT(DISTINCT pack) FROM pack_charts").fetchone()[0]
+
+    def _get_disk_charts(self, hashes: list[str]) -> dict[str, Chart]:
+        disk_charts = {}
+        for hash in hashes:
+            row = self._connection.execute("SELECT data FROM charts WHERE hash = ?", (hash,)).fetchone()
+            if row is not None:
+                disk_charts[hash] = Chart(**json.loads(row[0]))
+
+        return disk_charts
+
+    def to_disk(self, path: Path, writers: int = DEFAULT_WRITERS):
+        if self._connection is None or path != self._location:
+            self._location = path
+            self._connection = self.connect(path)
+
+        print(f"Saving {len(self._charts)} charts")
+        disk_charts = self._get_disk_charts(list(self._charts))
+        for hash, disk_chart in disk_charts.items():
+            # keep original data, only extend packs/diffs
+            disk_chart.packs.update(self._charts[hash].packs)
+            disk_chart.diffs.update(self._charts[hash].diffs)
+            self._charts[hash] = disk_chart
+
+        print(f"Saving {len(self._packs)} packs")
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO charts (hash, data) VALUES (?, ?)",
+                ((hash, chart.to_json()) for hash, chart in self._charts.items()),
+            )
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO pack_charts (pack, hash) VALUES (?, ?)",
+                ((pack, hash) for pack, hashes in self._packs.items() for hash in hashes),
+            )
+            self._save_search([chart for hash, chart in self._charts.items() if hash not in disk_charts])
+            if self._last_update is not None:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO metadata (key, value) VALUES ('last_update', ?)",
+                    (self._last_update.isoformat(),),
+                )
+
+        num_disk_charts, num_disk_packs = self._num_disk_charts, self._num_disk_packs
+        self._read_metadata()
+        print(
+            f"Saved {self._num_disk_charts - num_disk_charts} new charts and {self._num_disk_packs - num_disk_packs} "
+            "new packs"
+        )
+
+        self._charts.clear()
+        self._packs.clear()
+
+    def _save_search(self, new_charts: list[Chart]):
+        """Adds search keys of new charts within the current transaction. Dbs created before the search index existed
+        get it built from all the charts."""
+        if self._connection.execute("SELECT 1 FROM metadata WHERE key = 'search_index'").fetchone() is None:
+            print("Search index is missing, building it")
+            new_charts = (Chart(**json.loads(data)) for data, in self._connection.execute("SELECT data FROM charts"))
+            self._connection.execute("INSERT INTO metadata (key, value) VALUES ('search_index', '1')")
+
+        self._connection.executemany(
+            "INSERT OR IGNORE INTO search (field, key, hash) VALUES (?, ?, ?)",
+            ((field, key, chart.hash) for chart in new_charts for field, key in chart_search_keys(chart)),
+        )
+
+    def search(self, **criteria) -> list[str]:
+        return SQLiteSearchIndex(self._connection).search(**criteria)
+
+    def get_chart(self, hash_v3: str) -> Chart | None:
+        if self._charts:
+            raise RuntimeError(f"{len(self._charts)} pending changes, please call to_disk first.")
+
+        row = self._connection.execute("SELECT data FROM charts WHERE hash = ?", (hash_v3,)).fetchone()
+        if row is None:
+            return None
+
+        return Chart(**json.loads(row[0]))
+
+    def get_charts(self, pack: str) -> list[Chart]:
+        if self._charts:
+            raise RuntimeError(f"{len(self._charts)} pending changes, please call to_disk first.")
+
+        rows = self._connection.execute(
+            "SELECT charts.data FROM pack_charts JOIN charts USING (hash) WHERE pack_charts.pack = ?", (pack,)
+        )
+
+        return [Chart(**json.loads(data)) for data, in rows]
+
+    def remove_pack(self, pack: str, writers: int = DEFAULT_WRITERS) -> tuple[int, int]:
+        """Changes are saved right away in a single transaction, so there can't be any pending changes."""
+        kept, removed = remove_pack_from_charts(pack, self.get_charts(pack))
+        if not kept and not removed:
+            return 0, 0
+
+        self._last_update = datetime.datetime.now(tz=datetime.timezone.utc)
+
+        with self._connection:
+            self._connection.executemany(
+                "UPDATE charts SET data = ? WHERE hash = ?", ((chart.to_json(), chart.hash) for chart in kept)
+            )
+            self._connection.execute("DELETE FROM pack_charts WHERE pack = ?", (pack,))
+            self._connection.executemany("DELETE FROM charts WHERE hash = ?", ((hash,) for hash in removed))
+            self._connection.executemany("DELETE FROM search WHERE hash = ?", ((hash,) for hash in removed))
+            self._connection.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) VALUES ('last_update', ?)",
+                (self._last_update.isoformat(),),
+            )
+
+        self._read_metadata()
+
+        return len(kept), len(removed)
+
+    def export_json(self, path: Path, writers: int = DEFAULT_WRITERS):
+        """Writes the db in the json tree layout, e.g. for publishing it."""
+        packs_dir, charts_dir = prepare_db_dirs(path)
+
+        def export_shard(shard):
+            # every thread needs its own connection, hashes from a shard are a contiguous range of the primary key
+            connection = sqlite3.connect(self._location / self.FILENAME)
+            try:
+                rows = connection.execute(
+                    "SELECT hash, data FROM charts WHERE hash >= ? AND hash < ?", (shard, f"{shard}g")
+                )
+                for hash, data in rows:
+                    write_atomic(get_chart_path(charts_dir, hash), data)
+            finally:
+                connection.close()
+
+        print(f"Exporting {self.num_charts} charts")
+        run_parallel(export_shard, CHART_SHARDS, writers)
+
+        print(f"Exporting {self.num_packs} packs")
+        packs = defaultdict(list)
+        for pack, hash in self._connection.execute("SELECT pack, hash FROM pack_charts ORDER BY pack, hash"):
+            packs[pack].append(hash)
+
+        run_parallel(lambda pack: write_atomic(packs_dir / f"{pack}.json", json.dumps(packs[pack])), packs, writers)
+
+        print("Exporting search index")
+
+        def iter_charts():
+            for (data,) in self._connection.execute("SELECT data FROM charts"):
+                yield Chart(**json.loads(data))
+
+        SearchIndex(path).to_disk(iter_charts(), (), self._last_update.isoformat(), iter_charts, writers)
+
+        write_atomic(
+            path / "metadata.json",
+            json.dumps(
+                {
+                    "last_update": self._last_update.isoformat(),
+                    "num_charts": self._num_disk_charts,
+                    "num_packs": self._num_disk_packs,
+                },
+                sort_keys=True,
+                indent=2,
+            ),
+        )
+
+
+class SQLiteSearchIndex(SearchIndex):
+    """Search index kept in the `search` table of `SQLiteStorage`, it's updated in the same transactions as charts."""
+
+    def __init__(self, connection: sqlite3.Connection):
+        self._connection = connection
+
+    def lookup(self, field: str, key: str) -> set[str]:
+        rows = self._connection.execute("SELECT hash FROM search WHERE field = ? AND key = ?", (field, key))
+        return {hash for hash, in rows}
+
+    def iter_postings(self, field: str) -> Iterator[tuple[str, list[str]]]:
+        rows = self._connection.execute("SELECT key, hash FROM search WHERE field = ? ORDER BY key", (field,))
+        for key, group in groupby(rows, key=itemgetter(0)):
+            yield key, [hash for _, hash in group]
+
 
 STORAGE_DRIVERS = {
     "inmem": InMemStorage,
     "lazy": LazyStorage,
+    "sqlite": SQLiteStorage,
 }
@@ -0,0 +1,115 @@
+import os
+import queue
+import threading
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+from sm_db_gen.failures import NO_FAILURES, FailureBuffer
+from sm_db_gen.stats import NO_STATS, RunStats
+
+SIMFILE_SUFFIXES = (".sm", ".ssc")
+SCHEDULES = ("discovery", "inode")
+
+
+def is_simfile(name: str) -> bool:
+    return name.lower().endswith(SIMFILE_SUFFIXES)
+
+
+def iter_simfiles(paths: Iterable[Path], failures: FailureBuffer = NO_FAILURES) -> Iterator[Path]:
+    """Walks the directory trees in a single pass and yields `.sm` and `.ssc` files (case-insensitive) as soon as they
+    are found, so that processing can start before the whole tree has been visited. Paths that aren't directories are
+    yielded as they are. Every file is yielded once, even if the trees overlap. Symlinked directories are not
+    followed, just like in `Path.rglob`. The order only depends on the content of the trees. Directories that can't be
+    scanned are reported to `failures` and skipped."""
+    seen = set()
+
+    for path in paths:
+        path = Path(path)
+        if not path.is_dir():
+            if path not in seen:
+                seen.add(path)
+                yield path
+            continue
+
+        directories = [path]
+        while directories:
+            directory = directories.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    subdirectories = []
+                    simfiles = []
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(Path(entry.path))
+                        elif is_simfile(entry.name) and entry.is_file():
+                            simfiles.append(Path(entry.path))
+            except OSError as e:
+                failures.report(directory, "discovery", f"Failed to scan directory: {e}", exception=e)
+                continue
+
+            for p in sorted(simfiles):
+                if p not in seen:
+                    seen.add(p)
+                    yield p
+
+            # depth-first in a stable order, so that the discovery order is reproducible and a song's files are
+            # found together
+            directories.extend(sorted(subdirectories, reverse=True))
+
+
+def schedule_by_inode(paths: Iterable[Path], stats: dict[Path, os.stat_result]) -> list[Path]:
+    """Orders all the paths by their device and inode numbers, which on most file systems follow the order in which
+    the files were written, i.e. their placement on the disk, so that reading them turns into mostly sequential IO."""
+    return sorted(paths, key=lambda p: (stats[p].st_dev, stats[p].st_ino))
+
+
+class Prefetcher:
+    """Reads files in a dedicated thread, one by one in the given order and ahead of the workers that process them.
+    Contents of at most `budget` bytes are kept in memory until they're released by the consumer. A file that's bigger
+    than the whole budget is still read once nothing else is buffered."""
+
+    _DONE = object()
+
+    def __init__(self, budget: int, stats: RunStats = NO_STATS):
+        self._budget = budget
+        self._buffered = 0
+        self._condition = threading.Condition()
+        self._queue = queue.SimpleQueue()
+        self._stats = stats
+
+    def _read_all(self, paths: Iterable[Path]):
+        try:
+            for p in paths:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._buffered < self._budget)
+
+                with self._stats.timer("prefetch"):
+                    try:
+                        data = p.read_bytes()
+                    except OSError:
+                        data = None  # the worker reads the file again and reports the error
+
+                with self._condition:
+                    self._buffered += len(data or b"")
+                self._queue.put((p, data))
+        except BaseException as e:
+            self._queue.put(e)
+        finally:
+            self._queue.put(self._DONE)
+
+    def read(self, paths: Iterable[Path]) -> Iterator[tuple[Path, bytes | None]]:
+        """Yields `(path, content)` pairs, the content is `None` if the file couldn't be read."""
+        threading.Thread(target=self._read_all, args=(paths,), daemon=True).start()
+
+        while (item := self._queue.get()) is not self._DONE:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def release(self, data: bytes | None):
+        if not data:
+            return
+
+        with self._condition:
+            self._buffered -= len(data)
+            self._condition.notify()
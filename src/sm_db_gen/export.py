@@ -0,0 +1,34 @@
+import argparse
+from pathlib import Path
+
+from sm_db_gen.db import SQLiteStorage
+from sm_db_gen.writer import DEFAULT_WRITERS
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="Exports a db saved with the sqlite driver to the json tree layout",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--db", type=Path, default=Path("db_v2"), help="Path to the sqlite db directory")
+    parser.add_argument("output", type=Path, help="Path to the output json db directory", metavar="OUTPUT")
+    parser.add_argument(
+        "--writers", type=int, default=DEFAULT_WRITERS, help="Number of threads used to save the json files"
+    )
+
+    return parser
+
+
+def main():
+    parser = _get_parser()
+    args = parser.parse_args()
+
+    if not (args.db / SQLiteStorage.FILENAME).exists():
+        parser.error(f"{args.db / SQLiteStorage.FILENAME} doesn't exist")
+
+    storage = SQLiteStorage.from_disk(args.db)
+    storage.export_json(args.output, writers=args.writers)
+
+
+if __name__ == "__main__":
+    main()
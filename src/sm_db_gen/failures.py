@@ -0,0 +1,113 @@
+import json
+import os
+import queue
+import sys
+import threading
+from collections import Counter
+from pathlib import Path
+
+import tqdm
+
+WRITE_BATCH_SIZE = 1000
+
+
+class FailureBuffer:
+    """Collects failures of processing simfiles (parsing fallbacks, charts that couldn't be processed, mismatches with
+    the v1 db) as structured records. The buffer itself only keeps the records, e.g. in worker processes that send
+    them back to the parent's `FailureLog`."""
+
+    def __init__(self):
+        self.records = []
+
+    def report(
+        self,
+        p: Path,
+        stage: str,
+        message: str,
+        level: str | None = None,
+        exception: BaseException | None = None,
+    ):
+        self.add(
+            {
+                "path": os.fspath(p),
+                "stage": stage,
+                "level": level,
+                "exception": type(exception).__name__ if exception is not None else None,
+                "message": message,
+            }
+        )
+
+    def add(self, record: dict):
+        self.records.append(record)
+
+
+class NullFailures(FailureBuffer):
+    """Drop-in replacement that doesn't collect anything, used when the caller isn't interested in failures."""
+
+    def add(self, record: dict):
+        pass
+
+
+NO_FAILURES = NullFailures()
+
+
+class FailureLog(FailureBuffer):
+    """Writes failures as json lines to `path` and, if `echo` is set, to the console. Reporting only puts the record
+    in a queue, a single writer thread formats and writes them in batches, so that workers neither contend on the
+    output nor break the progress bar. Like the progress bar, the console output goes to stderr. Number of failures of
+    every stage and level is summed up in `summary`."""
+
+    def __init__(self, path: Path | None = None, echo: bool = False):
+        super().__init__()
+        self.summary = Counter()
+        self._lock = threading.Lock()
+        self._echo = echo
+        self._file = open(path, "w") if path is not None else None
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        if self._file is not None or echo:
+            self._thread = threading.Thread(target=self._write_all, daemon=True)
+            self._thread.start()
+
+    def add(self, record: dict):
+        with self._lock:
+            self.summary[(record["stage"], record["level"])] += 1
+
+        if self._thread is not None:
+            self._queue.put(record)
+
+    def _write_all(self):
+        done = False
+        while not done:
+            records = [self._queue.get()]
+            while len(records) < WRITE_BATCH_SIZE and not self._queue.empty():
+                records.append(self._queue.get())
+
+            if records[-1] is None:
+                records.pop()
+                done = True
+
+            if self._file is not None:
+                self._file.write("".join(json.dumps(record, sort_keys=True) + "\n" for record in records))
+            if self._echo:
+                for record in records:
+                    path = record["path"].encode("utf-8", "ignore").decode("utf-8")
+                    # multi-line messages, e.g. differences from the v1 db, start on their own line
+                    separator = "\n" if "\n" in record["message"] else " "
+                    tqdm.tqdm.write(f"{path}:{separator}{record['message']}", file=sys.stderr)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def summary_dict(self) -> dict:
+        return {
+            f"{stage} {level}" if level else stage: count
+            for (stage, level), count in sorted(self.summary.items(), key=lambda item: (item[0][0], item[0][1] or ""))
+        }
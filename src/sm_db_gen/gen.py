@@ -1,18 +1,36 @@
 import argparse
 import concurrent.futures
+import contextlib
+import csv
 import os
+import re
+import sys
+import threading
+import time
 from collections import Counter
+from collections.abc import Iterable, Iterator
 from functools import partial
 from hashlib import sha1
 from io import StringIO
+from itertools import islice
 from pathlib import Path
 from pprint import pprint
 
 import simfile
 import tqdm
 
-from sm_db_gen.db import STORAGE_DRIVERS, Chart, InMemStorage, StorageV2
-from sm_db_gen.reference import get_v1_reference
+from sm_db_gen.cache import LRUCache
+from sm_db_gen.changeset import Changeset
+from sm_db_gen.db import STORAGE_DRIVERS, Chart, InMemStorage, LazyStorage, SQLiteStorage, StorageShard, StorageV2
+from sm_db_gen.discovery import SCHEDULES, Prefetcher, iter_simfiles, schedule_by_inode
+from sm_db_gen.failures import NO_FAILURES, FailureBuffer, FailureLog
+from sm_db_gen.manifest import Journal, Manifest
+from sm_db_gen.merge import PARTITION_MODES, discovery_order_key, iter_partition, parse_partition, write_first_seen
+from sm_db_gen.packs import get_pack_dir_name, get_pack_name
+from sm_db_gen.reference import lookup_v1_reference
+from sm_db_gen.stats import DEFAULT_TOP_N, NO_STATS, RunStats
+from sm_db_gen.verify import compare_with_reference, format_differences
+from sm_db_gen.writer import DEFAULT_WRITERS
 
 DIFF_MAPPING = {
     # based on SM
@@ -39,17 +57,19 @@ DIFF_MAPPING = {
     "novice": "Beginner",
 }
 
+EXECUTORS = ("thread", "process")
+PROCESS_CHUNKSIZE = 32
+QUEUE_SIZE_PER_WORKER = 4
+DEFAULT_DEDUP_CACHE_SIZE = 10000
 
-def minimize_measure(measure):  # TODO doesn't work for empty charts
+
+def minimize_measure(measure):
     beats = [b.strip() for b in measure.strip().splitlines()]
-    is_minimal = False
 
-    while not is_minimal and len(beats) % 2 == 0:
-        even_are_zeros = all(beats[i] == "0" * len(beats[i]) for i in range(1, len(beats), 2))
-        if even_are_zeros:
-            beats = [beats[i] for i in range(0, len(beats), 2)]
-        else:
-            is_minimal = True
+    # odd rows are checked at once: the joined string is empty after stripping zeros only when every odd row is
+    # all zeros, so there's no per-row work except for the initial strip
+    while beats and len(beats) % 2 == 0 and not "".join(beats[1::2]).strip("0"):
+        beats = beats[::2]
 
     return beats
 
@@ -74,34 +94,40 @@ def normalize_bpms(raw_bpms):
     return ",".join(normalized)
 
 
-def process_chart(sim, chart, path) -> Chart | None:
-    notes = chart.notes
-    measures = [m.strip() for m in notes.split(",")]
-    minimized_chart = []
+def hash_chart(notes: str, raw_bpms: str) -> str:
+    # minimized measures are fed to sha1 one by one instead of building the whole minimized chart string
+    chart_hash = sha1(usedforsecurity=False)
+    separator = b""
 
-    for measure in measures:
+    for measure in notes.split(","):
+        measure = measure.strip()
         if not measure:  # can happen when file ends with `,;`
             continue
-        minimized_measure = minimize_measure(measure)
-        minimized_chart.extend(minimized_measure)
-        minimized_chart.append(",")
+        chart_hash.update(separator)
+        chart_hash.update("\n".join(minimize_measure(measure)).encode())
+        separator = b"\n,\n"
+
+    chart_hash.update(normalize_bpms(raw_bpms).encode())
+
+    return chart_hash.hexdigest()[:16]
+
+
+def process_chart(sim, chart, path, failures: FailureBuffer = NO_FAILURES) -> Chart | None:
     try:
-        minimized_chart_string = "\n".join(minimized_chart[:-1])
         raw_bpms = (getattr(chart, "bpms", None) or sim.bpms).replace("\n", "")
-        bpms = normalize_bpms(raw_bpms)
-        hash_v3 = sha1((minimized_chart_string + bpms).encode(), usedforsecurity=False).hexdigest()[:16]
+        hash_v3 = hash_chart(chart.notes, raw_bpms)
     except Exception as e:
-        print(f"{path}: Failed to process chart: {e}")
+        failures.report(path, "chart", f"Failed to process chart: {e}", exception=e)
         return None
 
     try:
-        pack_name = path.parent.parent.name.encode("utf-8", "ignore").decode("utf-8")
+        pack_name = get_pack_name(path)
 
         # there are some non-integer meters in the wild, StepMania fallbacks to 1
         try:
             diff_number = int(float(chart.meter)) if chart.meter else 1
         except ValueError as e:
-            print(f"{path}: Failed to process meter, falling back to 1: {e}")
+            failures.report(path, "chart", f"Failed to process meter, falling back to 1: {e}", "meter", e)
             diff_number = 1
 
         return Chart(
@@ -121,7 +147,7 @@ def process_chart(sim, chart, path) -> Chart | None:
             }
         )
     except Exception as e:
-        print(f"{path}: Failed to process chart: {e}")
+        failures.report(path, "chart", f"Failed to process chart: {e}", exception=e)
         raise
 
 
@@ -137,7 +163,8 @@ def _get_parser():
     parser.add_argument(
         "--verify-with-v1-db",
         type=Path,
-        help="When the path to v1 db is provided, new metadata will be compared against it",
+        help="When the path to v1 db (or its index built with sm-db-v1-index) is provided, new metadata will be "
+        "compared against it",
     )
     parser.add_argument(
         "--workers",
@@ -150,59 +177,473 @@ def _get_parser():
     parser.add_argument(
         "--db-driver", choices=STORAGE_DRIVERS, default="lazy", help="Driver for interacting with the db"
     )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        default=DEFAULT_WRITERS,
+        help="Number of threads used to save the db, more of them help with fast disks",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=EXECUTORS,
+        default="thread",
+        help="Pool used by workers. Processes avoid GIL contention at the cost of sending results back to the parent",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=0,
+        help=f"Maximum number of tasks waiting for workers while the directories are still being scanned, "
+        f"0 means {QUEUE_SIZE_PER_WORKER} per worker. Tasks are batched by {PROCESS_CHUNKSIZE} for processes",
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=SCHEDULES,
+        default="discovery",
+        help="Order of reading simfiles. `discovery` follows the directory walk pack by pack and song by song, "
+        "`inode` scans the whole trees first and reads files in the order of their inodes, which usually follows "
+        "their placement on disk",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="Read simfiles sequentially in a dedicated thread ahead of the workers, keeping at most this many MiB of "
+        "their content in memory, with --executor process only the content that hasn't been sent to the workers yet. "
+        "Helps with spinning disks, 0 disables it",
+        metavar="MIB",
+    )
+    parser.add_argument(
+        "--dedup-cache-size",
+        type=int,
+        default=DEFAULT_DEDUP_CACHE_SIZE,
+        help="Number of the most recently processed simfiles whose results are reused for byte-identical copies from "
+        "other packs, per worker process with --executor process. 0 disables it",
+        metavar="N",
+    )
+    parser.add_argument(
+        "--hash-only",
+        type=Path,
+        help="Only compute chart hashes and write them as `path,stepstype,difficulty,hash` csv lines to the given file "
+        "(`-` for stdout). The db is neither read nor written",
+        metavar="OUTPUT",
+    )
+    parser.add_argument(
+        "--sharded",
+        action="store_true",
+        help="Let every worker collect results on its own and merge them at the end. The first discovered occurrence "
+        "of a chart is the canonical one, so the result doesn't depend on the scheduling",
+    )
+    parser.add_argument(
+        "--changesets",
+        type=Path,
+        help="After every save of the db, write an archive with the changed files to this directory, so that copies "
+        "of the db can be updated with `sm-db-apply-changeset`. Not supported by the sqlite driver",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--partition",
+        type=parse_partition,
+        help="Process only one of COUNT partitions of the simfiles into a partial db, e.g. on one of many machines. "
+        "Partial dbs are combined with `sm-db-merge`. All partitions have to be given the same paths in the same "
+        "order. Implies --sharded",
+        metavar="INDEX/COUNT",
+    )
+    parser.add_argument(
+        "--partition-by",
+        choices=PARTITION_MODES,
+        default="pack",
+        help="Split simfiles into partitions by their pack or by their path",
+    )
+    parser.add_argument(
+        "--ignore-manifest",
+        action="store_true",
+        help="Process all simfiles, even the ones that haven't changed since they were saved to the db",
+    )
+    parser.add_argument(
+        "--manifest-digest",
+        action="store_true",
+        help="Store content digests in the manifest to also skip simfiles that were touched, but not modified",
+    )
+    parser.add_argument(
+        "--reimport-packs",
+        action="store_true",
+        help="Every PATH is a pack directory that replaces the pack of the same name in the db. Charts that are no "
+        "longer in the pack are removed from the db unless other packs have them",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=0,
+        help="Save the db, the manifest and the journal of processed simfiles after every this many simfiles, "
+        "0 disables it",
+        metavar="N",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=0,
+        help="Save the db, the manifest and the journal of processed simfiles after every this many seconds, "
+        "0 disables it",
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip simfiles that were saved by checkpoints of an interrupted run, even when the manifest is ignored",
+    )
+    parser.add_argument(
+        "--stats-json",
+        type=Path,
+        help="Write time spent in every stage, per-file latency histogram, the slowest simfiles and the number of "
+        "simfiles that needed each parsing fallback to the given file",
+    )
+    parser.add_argument(
+        "--stats-top", type=int, default=DEFAULT_TOP_N, help="Number of the slowest simfiles listed in --stats-json"
+    )
+    parser.add_argument(
+        "--failure-log",
+        type=Path,
+        help="Write failures of parsing and processing simfiles and mismatches with the v1 db to the given file as json "
+        "lines",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="Print failures to the console too, not just their summary"
+    )
 
     return parser
 
 
-def load_simfile(p: Path) -> simfile.Simfile | None:
-    try:
-        sim = simfile.open(str(p))
-    except Exception as e:
-        print(f"{str(p).encode('utf-8', 'ignore').decode('utf-8')}: Failed to parse in strict mode: {e}")
+def decode_simfile(data: bytes) -> str | None:
+    """Decodes the content with the first encoding that succeeds, the same way `simfile.open` detects it. Newlines are
+    translated just like when reading a file in text mode."""
+    for encoding in simfile.ENCODINGS:
+        try:
+            text = data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+    return None
+
+
+def parse_simfile(text: str, p: Path, strict: bool = True) -> simfile.Simfile:
+    # `simfile.open` picks the implementation by the suffix and only then falls back to peeking at the content
+    suffix = p.suffix.lower()
+    if suffix == ".ssc":
+        return simfile.SSCSimfile(string=text, strict=strict)
+    if suffix == ".sm":
+        return simfile.SMSimfile(string=text, strict=strict)
+
+    return simfile.loads(text, strict=strict)
+
+
+def is_supported_steps_type(stepstype: str) -> bool:
+    # in lua we only supported: dance-{single,double,solo,routine,couple}
+    return stepstype.startswith("dance") and stepstype != "dance-threepanel"
+
+
+MSD_COMMENT = re.compile(r"//[^\n]*")
+SM_CHART_COMPONENTS = 6
+
+
+def scan_msd(text: str) -> list[list[str]] | None:
+    """Splits MSD text into parameters' components. This only supports the well-formed subset of MSD: no escapes,
+    no stray text between parameters, no `#` inside values and no missing `;`. Returns None for anything else, in which
+    case the output could differ from what `simfile` (msdparser) does in strict mode."""
+    if "\\" in text:
+        return None
+
+    text = MSD_COMMENT.sub("", text)
+    params = []
+    end = -1
+
+    while True:
+        start = text.find("#", end + 1)
+        stray_text = text[end + 1 :] if start == -1 else text[end + 1 : start]
+        if stray_text and not stray_text.isspace() and stray_text != "\ufeff":
+            return None
+        if start == -1:
+            return params
+
+        end = text.find(";", start)
+        if end == -1:
+            return None
+
+        body = text[start + 1 : end]
+        if "#" in body:
+            return None
+
+        params.append(body.split(":"))
+
+
+def fast_chart_hashes(text: str, suffix: str) -> list[tuple[str, str, str]] | None:
+    """Computes hashes of supported charts by scanning the raw MSD text just for the fields the hash depends on,
+    without building `simfile` objects. Returns `(stepstype, difficulty, hash)` per chart, or None when the file isn't
+    simple enough for the fast path (see `scan_msd`) and `load_simfile` has to be used instead."""
+    params = scan_msd(text)
+    if params is None:
+        return None
+
+    # (stepstype, difficulty, notes, bpms) per chart, values are the same as in `simfile` models
+    charts = []
+    sim_bpms = None
+
+    if suffix == ".sm":
+        for components in params:
+            key = components[0].upper()
+            if key == "NOTES":
+                if len(components) - 1 < SM_CHART_COMPONENTS:
+                    return None  # strict mode would fail
+                stepstype, _, difficulty, _, _, notes = (c.strip() for c in components[1 : SM_CHART_COMPONENTS + 1])
+                charts.append([stepstype, difficulty, notes, None])
+            elif key == "BPMS":
+                sim_bpms = components[1] if len(components) > 1 else None
+    elif suffix == ".ssc":
+        chart = None
+        for components in params:
+            key = components[0].upper()
+            value = components[1] if len(components) > 1 else None
+            if key == "NOTEDATA":
+                chart = {}
+                charts.append(chart)
+            elif chart is not None:
+                chart[key] = value
+            elif key == "BPMS":
+                sim_bpms = value
+
+        charts = [
+            [c.get("STEPSTYPE"), c.get("DIFFICULTY"), c.get("NOTES", c.get("NOTES2")), c.get("BPMS")] for c in charts
+        ]
+    else:
+        return None
+
+    hashes = []
+    for stepstype, difficulty, notes, bpms in charts:
+        if stepstype is None or difficulty is None:
+            return None
+        if not is_supported_steps_type(stepstype) or not notes:
+            continue
+
+        try:
+            hash_v3 = hash_chart(notes, (bpms or sim_bpms).replace("\n", ""))
+        except Exception:
+            return None  # let the regular path report it
+
+        hashes.append((stepstype, difficulty, hash_v3))
+
+    return hashes
+
+
+def chart_hashes(
+    p: Path, data: bytes | None = None, failures: FailureBuffer = NO_FAILURES
+) -> list[tuple[str, str, str]]:
+    """Returns `(stepstype, difficulty, hash)` of every supported chart of the simfile. The fast path is tried first
+    and `load_simfile` is used only when it can't handle the file."""
+    if data is None:
+        data = p.read_bytes()
+
+    text = decode_simfile(data)
+    if text is not None:
+        hashes = fast_chart_hashes(text, p.suffix.lower())
+        if hashes is not None:
+            return hashes
+
+    sim = load_simfile(p, data, failures=failures)
+    if sim is None:
+        return []
+
+    hashes = []
+    for chart in sim.charts:
+        if chart.stepstype is None or not is_supported_steps_type(chart.stepstype) or not chart.notes:
+            continue
+
         try:
-            sim = simfile.open(str(p), strict=False)
-        except Exception as e:  # can be an SSC with .sm suffix...
-            print(f"{str(p).encode('utf-8', 'ignore').decode('utf-8')}: Failed to parse in non-strict mode: {e}")
+            raw_bpms = (getattr(chart, "bpms", None) or sim.bpms).replace("\n", "")
+            hashes.append((chart.stepstype, chart.difficulty, hash_chart(chart.notes, raw_bpms)))
+        except Exception as e:
+            failures.report(p, "chart", f"Failed to process chart: {e}", exception=e)
+
+    return hashes
+
+
+def chart_hashes_batch(paths: list[Path]) -> tuple[list[list[tuple[str, str, str]]], list[dict]]:
+    """Failures are returned for the whole batch, so that they can be written by the parent."""
+    failures = FailureBuffer()
+    return [chart_hashes(p, failures=failures) for p in paths], failures.records
+
+
+def load_simfile(
+    p: Path, data: bytes | None = None, stats: RunStats = NO_STATS, failures: FailureBuffer = NO_FAILURES
+) -> simfile.Simfile | None:
+    """Parses the simfile with increasingly lenient fallbacks. The file is read only once, all the fallbacks work on
+    the same buffer. The fallback that succeeded is counted in `stats`, the ones that failed are reported to
+    `failures`."""
+    if data is None:
+        with stats.timer("read"):
+            data = p.read_bytes()
+
+    with stats.timer("parse"):
+        return _load_simfile(p, data, stats, failures)
+
+
+def _load_simfile(p: Path, data: bytes, stats: RunStats, failures: FailureBuffer) -> simfile.Simfile | None:
+    text = decode_simfile(data)
+    if text is None:
+        failures.report(p, "parse", "Failed to detect encoding", "encoding")
+    else:
+        attempts = (
+            ("in strict mode", lambda: parse_simfile(text, p)),
+            ("in non-strict mode", lambda: parse_simfile(text, p, strict=False)),
+            # can be an SSC with .sm suffix...
+            ("as SSC", lambda: simfile.SSCSimfile(file=StringIO(text), strict=False)),
+        )
+        for description, attempt in attempts:
             try:
-                sim = simfile.SSCSimfile(file=StringIO(p.read_text()), strict=False)
+                sim = attempt()
             except Exception as e:
-                print(f"{str(p).encode('utf-8', 'ignore').decode('utf-8')}: Failed to parse as SSC: {e}")
-                print(
-                    f"{str(p).encode('utf-8', 'ignore').decode('utf-8')}: Attempting to reject lines with garbled data..."
-                )
-                raw_bytes = p.read_bytes().replace(b"\xfe\xff", b"")
-                split_bytes = raw_bytes.split(b"\n")
-                processed_split_lines = []
-                for b in split_bytes:
-                    for encoding in simfile.ENCODINGS:
-                        try:
-                            decoded = b.decode(encoding)
-                            processed_split_lines.append(decoded)
-                            break
-                        except UnicodeDecodeError:
-                            continue
-                    else:
-                        print(f"Can't decode line {b}, skipping it")
-
-                processed = "\n".join(processed_split_lines)
-                try:
-                    sim = simfile.load(StringIO(processed), strict=False)
-                except Exception as e:  # give up
-                    print(f"{str(p).encode('utf-8', 'ignore').decode('utf-8')}: Giving up because of: {e}")
-                    return None
+                failures.report(p, "parse", f"Failed to parse {description}: {e}", description, e)
+                continue
+
+            stats.count_fallback(description)
+            return sim
+
+    split_bytes = data.replace(b"\xfe\xff", b"").split(b"\n")
+    processed_split_lines = []
+    for b in split_bytes:
+        for encoding in simfile.ENCODINGS:
+            try:
+                decoded = b.decode(encoding)
+                processed_split_lines.append(decoded)
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            failures.report(p, "parse", f"Can't decode line {b}, skipping it", "garbled line")
 
+    processed = "\n".join(processed_split_lines)
+    try:
+        sim = simfile.load(StringIO(processed), strict=False)
+    except Exception as e:  # give up
+        failures.report(p, "parse", f"Giving up because of: {e}", "without garbled lines", e)
+        stats.count_fallback("failed")
+        return None
+
+    stats.count_fallback("without garbled lines")
     return sim
 
 
-def process_sim(p: Path, v1_db, mismatches, storage: StorageV2):
-    sim = load_simfile(p)
+class SimfileCache:
+    """Remembers results of processing by the digest of simfile's content, so that byte-identical copies of a simfile
+    from other packs are not parsed again. Only the pack of the copy differs. Keeping the results of every simfile
+    would be a second copy of the db in memory, so only `size` most recently used simfiles are remembered."""
+
+    def __init__(self, size: int = DEFAULT_DEDUP_CACHE_SIZE):
+        self._entries = LRUCache(size)
+
+    def get(self, digest: str, pack_name: str) -> tuple[list[tuple[tuple, Chart]] | None, Counter | None] | None:
+        entry = self._entries.get(digest, None)
+        if entry is None:
+            return None
+
+        charts, mismatches = entry
+        if charts is not None:
+            charts = [(source, c.copy(pack_name=pack_name, packs={pack_name})) for source, c in charts]
+
+        return charts, mismatches
+
+    def put(self, digest: str, charts: list[tuple[tuple, Chart]] | None, mismatches: Counter):
+        if charts is not None:
+            charts = [(source, c.copy()) for source, c in charts]
+
+        self._entries.put(digest, (charts, mismatches or None))
+
+
+# each worker process gets its own cache, it's created by the first batch
+_process_cache = None
+
+
+def analyze_sim(
+    p: Path,
+    v1_db,
+    mismatches,
+    cache: SimfileCache | None = None,
+    stats: RunStats = NO_STATS,
+    data: bytes | None = None,
+    failures: FailureBuffer = NO_FAILURES,
+) -> tuple[list[Chart] | None, str | None]:
+    """`data` is the content of the simfile if it has already been read, e.g. by the prefetcher. Along with the charts,
+    sha1 digest of the content that's computed for the `cache` is returned, so that the manifest doesn't have to read
+    the file again. Without a cache the digest is `None`."""
+    start = time.perf_counter()
+    charts, digest = _analyze_sim_cached(p, mismatches, cache, stats, data, failures)
+
+    if charts is not None and v1_db:
+        # pack names differ between copies of a simfile, so every copy is verified on its own
+        for source, j in charts:
+            with stats.timer("verify"):
+                _verify_chart(p, source, j, v1_db, mismatches, failures)
+
+    stats.add_file(p, time.perf_counter() - start)
+
+    if charts is None:
+        return None, digest
+
+    return [j for _, j in charts], digest
+
+
+def _analyze_sim_cached(
+    p: Path,
+    mismatches,
+    cache: SimfileCache | None,
+    stats: RunStats,
+    data: bytes | None,
+    failures: FailureBuffer,
+) -> tuple[list[tuple[tuple, Chart]] | None, str | None]:
+    if cache is None:
+        return _analyze_sim(p, mismatches, data, stats, failures), None
+
+    if data is None:
+        with stats.timer("read"):
+            data = p.read_bytes()
+
+    with stats.timer("dedup"):
+        digest = sha1(data, usedforsecurity=False).hexdigest()
+        cached = cache.get(digest, get_pack_name(p))
+
+    if cached is not None:
+        stats.count("cache_hits")
+        charts, sim_mismatches = cached
+        if sim_mismatches:
+            mismatches.update(sim_mismatches)
+        return charts, digest
+
+    sim_mismatches = Counter()
+    charts = _analyze_sim(p, sim_mismatches, data, stats, failures)
+    cache.put(digest, charts, sim_mismatches)
+    mismatches.update(sim_mismatches)
+
+    return charts, digest
+
+
+def _analyze_sim(
+    p: Path,
+    mismatches,
+    data: bytes | None = None,
+    stats: RunStats = NO_STATS,
+    failures: FailureBuffer = NO_FAILURES,
+) -> list[tuple[tuple, Chart]] | None:
+    """Returns charts along with `(stepstype, difficulty, number of fields)` of their source in the simfile, which is
+    all that's needed to verify them, so that the notes don't have to be kept."""
+    sim = load_simfile(p, data, stats, failures)
     if sim is None:
-        return
+        return None
 
     charts = []
     for chart in sim.charts:
-        # in lua we only supported: dance-{single,double,solo,routine,couple}
-        if not chart.stepstype.startswith("dance") or chart.stepstype == "dance-threepanel":
+        if not is_supported_steps_type(chart.stepstype):
             mismatches[f"skipped steps type {chart.stepstype}"] += 1
             continue
 
@@ -210,134 +651,421 @@ def process_sim(p: Path, v1_db, mismatches, storage: StorageV2):
             mismatches[f"no notes {chart.difficulty}"] += 1
             continue
 
-        j = process_chart(sim, chart, p)
+        with stats.timer("hash"):
+            j = process_chart(sim, chart, p, failures)
         if not j:
             continue
 
-        charts.append(j)
+        charts.append(((chart.stepstype, chart.difficulty, len(chart)), j))
 
-        if not v1_db:
-            continue
+    return charts
 
-        reference = get_v1_reference(v1_db, j.hash)
-
-        if not reference:
-            if chart.difficulty == "Edit":
-                # see https://github.com/florczakraf/stepmania-chart-db-generator/issues/2
-                mismatches["missing_edit"] += 1
-            elif not chart.difficulty.istitle():
-                # see https://github.com/florczakraf/stepmania-chart-db-generator/issues/4
-                mismatches[f"missing non-canonical difficulty {chart.difficulty}"] += 1
-            elif len(chart) < 7:
-                # see https://github.com/florczakraf/stepmania-chart-db-generator/issues/5
-                mismatches["missing NOTES props"] += 1
-            else:
-                print(f"{p}: missing reference for {chart.stepstype} {chart.difficulty} {j.hash}")
-                mismatches["missing_reference"] += 1
 
-            continue
+def _verify_chart(p: Path, source: tuple, j: Chart, v1_db, mismatches, failures: FailureBuffer):
+    stepstype, difficulty, num_fields = source
+    reference = lookup_v1_reference(v1_db, j.hash)
 
-        buf = ""
-        n_mismatches = 0
-
-        if reference and j != reference:
-            for k in reference.keys():
-                ref = reference[k]
-                new = getattr(j, k)
-                if ref != new:
-                    if k in (
-                        "diff_number",  # usually happens in case of DDR/X/ITG mismatches
-                        "pack_name",
-                        "subtitle",  # sometimes used for tech
-                        "diff",  # tournaments started to change this so that all songs align nicely
-                    ):
-                        mismatches[k] += 1
-                        continue
-
-                    if k == "steps_type":
-                        if sorted([ref, new]) == sorted(["dance-couple", "dance-double"]):
-                            mismatches["couple/double"] += 1
-                            continue
-
-                    if k in (
-                        "title",
-                        "directory",
-                        "artist",
-                        "titletranslit",
-                        "artisttranslit",
-                    ):
-                        ref = ref.lower().replace("[", "(").replace("]", ")").replace("~", "-")
-                        new = new.lower().replace("[", "(").replace("]", ")").replace("~", "-")
-
-                        if (ref in new) or (
-                            new in ref
-                        ):  # usually happens in case of prefixing with tiers in tournaments or "feat."
-                            mismatches["contains_" + k] += 1
-                            continue
-                        if k == "directory":
-                            mismatches[k] += 1
-                            continue
-
-                    n_mismatches += 1
-                    buf += f"\t{k}:\n"
-                    buf += f"\t\tRef: {ref}\n"
-                    buf += f"\t\tNew: {new}\n"
-                    buf += "\n"
-
-        if n_mismatches > 1:  # we can live with one mismatch if other stuff matches
-            print(f"{str(p).encode('utf-8', 'ignore').decode('utf-8')}:")
-            print(buf)
-
-        mismatches[f"n_mismatches {n_mismatches}"] += 1
-
-    storage.add_song(charts)
+    if not reference:
+        if difficulty == "Edit":
+            # see https://github.com/florczakraf/stepmania-chart-db-generator/issues/2
+            mismatches["missing_edit"] += 1
+        elif not difficulty.istitle():
+            # see https://github.com/florczakraf/stepmania-chart-db-generator/issues/4
+            mismatches[f"missing non-canonical difficulty {difficulty}"] += 1
+        elif num_fields < 7:
+            # see https://github.com/florczakraf/stepmania-chart-db-generator/issues/5
+            mismatches["missing NOTES props"] += 1
+        else:
+            failures.report(
+                p, "verify", f"missing reference for {stepstype} {difficulty} {j.hash}", "missing reference"
+            )
+            mismatches["missing_reference"] += 1
 
+        return
 
-def main():
-    parser = _get_parser()
-    args = parser.parse_args()
+    differences = compare_with_reference(j, reference, mismatches)
+    n_mismatches = len(differences)
+
+    if n_mismatches > 1:  # we can live with one mismatch if other stuff matches
+        failures.report(p, "verify", format_differences(differences), "differences")
+
+    mismatches[f"n_mismatches {n_mismatches}"] += 1
+
+
+def process_sim_isolated(
+    p: Path, v1_db, stats: RunStats = NO_STATS, data: bytes | None = None, failures: FailureBuffer = NO_FAILURES
+) -> tuple[list[Chart] | None, Counter, str | None]:
+    """Variant of `analyze_sim` for worker processes that can't share the counter with the parent. Results are
+    merged by the caller."""
+    mismatches = Counter()
+    charts, digest = analyze_sim(p, v1_db, mismatches, _process_cache, stats, data, failures)
+
+    return charts, mismatches, digest
+
+
+class WorkerShards:
+    """Hands out a separate storage shard and mismatch counter to every worker thread, so that workers don't contend
+    on shared state. Shards are merged once all the work is done."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.shards = []
+        self.counters = []
+
+    def get(self) -> tuple[StorageShard, Counter]:
+        try:
+            return self._local.shard, self._local.mismatches
+        except AttributeError:
+            shard, mismatches = StorageShard(), Counter()
+            with self._lock:
+                self.shards.append(shard)
+                self.counters.append(mismatches)
+
+            self._local.shard, self._local.mismatches = shard, mismatches
+            return shard, mismatches
+
+    def merge_into(self, storage: StorageV2, mismatches: Counter) -> StorageShard:
+        for counter in self.counters:
+            mismatches.update(counter)
+
+        merged = StorageShard.merge(self.shards)
+        merged.save(storage)
+
+        return merged
+
+
+def process_sim_sharded(
+    order: int,
+    p: Path,
+    v1_db,
+    shards: WorkerShards,
+    cache: SimfileCache | None = None,
+    stats: RunStats = NO_STATS,
+    data: bytes | None = None,
+    failures: FailureBuffer = NO_FAILURES,
+) -> tuple[list[Chart] | None, str | None]:
+    shard, mismatches = shards.get()
+    charts, digest = analyze_sim(p, v1_db, mismatches, cache, stats, data, failures)
+    if charts is not None:
+        shard.add_song(order, charts)
+
+    return charts, digest
+
+
+def process_sims_isolated(
+    batch: list[tuple[int, Path, bytes | None]],
+    v1_db,
+    top_n: int | None = None,
+    cache_size: int = DEFAULT_DEDUP_CACHE_SIZE,
+) -> tuple[list[tuple[list[Chart] | None, Counter, str | None]], RunStats | None, list[dict]]:
+    """Stats are collected only when `top_n` is given. Stats and failures are returned for the whole batch."""
+    global _process_cache
+    if _process_cache is None:
+        _process_cache = SimfileCache(cache_size)
+
+    stats = RunStats(top_n) if top_n is not None else None
+    failures = FailureBuffer()
+    results = [process_sim_isolated(p, v1_db, stats or NO_STATS, data, failures) for _, p, data in batch]
+
+    return results, stats, failures.records
 
-    expanded_paths = set()
-    for path in args.paths:
-        p = Path(path)
-        if p.is_dir():
-            sms = p.rglob("*.[sS][mM]")
-            sscs = p.rglob("*.[sS][sS][cC]")
-            expanded_paths.update(sms)
-            expanded_paths.update(sscs)
-        else:
-            expanded_paths.add(p)
 
+def batched(iterable: Iterable, n: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        yield batch
+
+
+def run_bounded(executor: concurrent.futures.Executor, fn, items: Iterable, max_in_flight: int) -> Iterator[tuple]:
+    """Like `executor.map`, but consumes `items` lazily and keeps at most `max_in_flight` tasks submitted at a time.
+    Yields `(item, result)` pairs in the order of completion."""
+    pending = {}
+
+    for item in items:
+        if len(pending) >= max_in_flight:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+
+        pending[executor.submit(fn, item)] = item
+
+    for future in concurrent.futures.as_completed(pending):
+        yield pending[future], future.result()
+
+
+def hash_only(args, failures: FailureBuffer):
+    """Writes `path,stepstype,difficulty,hash` csv lines for all the simfiles without touching the db."""
+    executor_cls = (
+        concurrent.futures.ProcessPoolExecutor if args.executor == "process" else concurrent.futures.ThreadPoolExecutor
+    )
+    max_in_flight = args.queue_size or QUEUE_SIZE_PER_WORKER * args.workers
+
+    def discover_paths(progress):
+        for p in iter_simfiles(args.paths, failures):
+            progress.total += 1
+            yield p
+
+    output = sys.stdout if str(args.hash_only) == "-" else open(args.hash_only, "w", newline="")
+    # when the csv goes to stdout, anything else that would be printed goes to stderr
+    diagnostics = contextlib.redirect_stdout(sys.stderr) if output is sys.stdout else contextlib.nullcontext()
+    try:
+        writer = csv.writer(output)
+        with diagnostics, executor_cls(max_workers=args.workers) as executor:
+            with tqdm.tqdm(total=0) as progress:
+                batches = batched(discover_paths(progress), PROCESS_CHUNKSIZE)
+                for batch, (results, records) in run_bounded(executor, chart_hashes_batch, batches, max_in_flight):
+                    for failure in records:
+                        failures.add(failure)
+                    for p, hashes in zip(batch, results):
+                        writer.writerows((os.fspath(p), *row) for row in hashes)
+                        progress.update()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def run(args, failures: FailureLog):
+    if args.hash_only:
+        hash_only(args, failures)
+        return
+
+    checkpoints = args.checkpoint_every > 0 or args.checkpoint_interval > 0
     mismatches = Counter()
+    run_stats = RunStats(args.stats_top) if args.stats_json else NO_STATS
+    start = time.perf_counter()
 
+    driver = STORAGE_DRIVERS[args.db_driver]
     if args.db.exists():
         print(f"Loading database from: {args.db}")
-        driver = STORAGE_DRIVERS[args.db_driver]
-        storage = driver.from_disk(args.db)
+        with run_stats.timer("from_disk"):
+            storage = driver.from_disk(args.db)
 
         print("Packs:", storage.num_packs)
         print("Charts:", storage.num_charts)
+    elif driver is SQLiteStorage:
+        storage = SQLiteStorage.create(args.db)
+    elif driver is LazyStorage and checkpoints:
+        # keeps only the songs since the last checkpoint in memory
+        storage = LazyStorage()
     else:
         storage = InMemStorage()
 
-    process_sim_stub = partial(
-        process_sim,
-        v1_db=args.verify_with_v1_db,
-        mismatches=mismatches,
-        storage=storage,
-    )
+    if args.changesets:
+        storage.changeset = Changeset(args.changesets, StorageV2.read_last_update(args.db))
+
+    if args.resume:
+        journal = Journal.from_disk(args.db)
+        print(f"Resuming after {len(journal)} simfiles saved by checkpoints")
+    else:
+        journal = Journal(args.db)
+        journal.remove()
+
+    # checkpoints save the manifest of the interrupted run too, so it's used even when it's otherwise ignored
+    if args.db.exists() and (not args.ignore_manifest or len(journal)):
+        with run_stats.timer("manifest_load"):
+            manifest = Manifest.from_disk(args.db, use_digest=args.manifest_digest)
+    else:
+        manifest = Manifest(use_digest=args.manifest_digest)
+
+    # packs are removed only once, a resumed run has already saved some of their simfiles again
+    if args.reimport_packs and args.db.exists() and not len(journal):
+        for pack_dir in args.paths:
+            pack = get_pack_dir_name(pack_dir)
+            with run_stats.timer("remove_pack"):
+                updated, removed = storage.remove_pack(pack, writers=args.writers)
+            print(f"Removed pack {pack}: {updated} charts updated, {removed} charts removed")
+            manifest.forget(lambda p: get_pack_name(p) == pack)
+
+    stat_results = {}
+    num_unchanged = 0
+    max_in_flight = args.queue_size or QUEUE_SIZE_PER_WORKER * args.workers
+
+    def discover_pending_paths(progress):
+        nonlocal num_unchanged
+
+        if args.partition:
+            simfiles = iter_partition(args.paths, args.partition, args.partition_by, failures)
+        else:
+            simfiles = iter_simfiles(args.paths, failures)
+
+        for p in run_stats.timed(simfiles, "discovery"):
+            with run_stats.timer("manifest_check"):
+                stat = p.stat()
+                unchanged = manifest.is_unchanged(p, stat)
+
+            if unchanged or p in journal:
+                num_unchanged += 1
+                continue
+
+            stat_results[p] = stat
+            progress.total += 1
+            yield p
+
+    pending_paths = []
+    last_checkpoint = time.monotonic()
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
-        with tqdm.tqdm(total=len(expanded_paths)) as progress:
-            futures = executor.map(process_sim_stub, expanded_paths)
-            for _ in futures:
-                progress.update()
+    prefetcher = Prefetcher(args.prefetch * 2**20, run_stats) if args.prefetch > 0 else None
 
-    storage.to_disk(args.db)
+    def pending_items(progress, release: bool = False) -> Iterator[tuple[int, Path, bytes | None]]:
+        """With `release`, the prefetched content is released as soon as it's handed over, otherwise workers release
+        it once they're done with it. The main thread must never hold unreleased content while it waits for the
+        prefetcher, or it would wait forever once the budget is exhausted."""
+        paths = discover_pending_paths(progress)
+        if args.schedule == "inode":
+            paths = schedule_by_inode(paths, stat_results)
+
+        contents = prefetcher.read(paths) if prefetcher else ((p, None) for p in paths)
+        for order, (p, data) in enumerate(contents):
+            if args.partition:
+                # orders of simfiles have to be comparable between partial dbs
+                order = discovery_order_key(args.paths, p)
+            if release:
+                prefetcher.release(data)
+            yield order, p, data
+
+    def record(p, charts, digest):
+        nonlocal last_checkpoint
+
+        manifest.update(p, stat_results.pop(p), [c.hash for c in charts or []], digest)
+        if not checkpoints:
+            return
+
+        pending_paths.append(p)
+        if (args.checkpoint_every and len(pending_paths) >= args.checkpoint_every) or (
+            args.checkpoint_interval and time.monotonic() - last_checkpoint >= args.checkpoint_interval
+        ):
+            with run_stats.timer("checkpoint"):
+                save_checkpoint()
+            last_checkpoint = time.monotonic()
+
+    def save_checkpoint():
+        # the journal goes last, so it never lists simfiles whose charts haven't been saved
+        storage.to_disk(args.db, writers=args.writers)
+        manifest.to_disk(args.db)
+        journal.append(pending_paths)
+        pending_paths.clear()
+
+    shards = WorkerShards() if args.sharded else None
+
+    if args.executor == "process":
+        process_sims_stub = partial(
+            process_sims_isolated,
+            v1_db=args.verify_with_v1_db,
+            top_n=args.stats_top if args.stats_json else None,
+            cache_size=args.dedup_cache_size,
+        )
+        if shards:
+            # results are collected by the main process only, so a single shard is enough
+            shard, _ = shards.get()
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+            with tqdm.tqdm(total=0) as progress:
+                # the content is sent to worker processes along with whole batches, so the budget only bounds reading
+                # ahead of the batches
+                batches = batched(pending_items(progress, release=prefetcher is not None), PROCESS_CHUNKSIZE)
+                for batch, (results, batch_stats, records) in run_bounded(
+                    executor, process_sims_stub, batches, max_in_flight
+                ):
+                    if batch_stats is not None:
+                        run_stats.merge(batch_stats)
+                    for failure in records:
+                        failures.add(failure)
+                    for (order, p, _), (charts, sim_mismatches, digest) in zip(batch, results):
+                        mismatches.update(sim_mismatches)
+                        if charts is not None:
+                            if shards:
+                                shard.add_song(order, charts)
+                            else:
+                                storage.add_song(charts)
+                        record(p, charts, digest)
+                        progress.update()
+    else:
+        cache = SimfileCache(args.dedup_cache_size)
+
+        def process_item(item):
+            order, p, data = item
+            try:
+                if shards:
+                    return process_sim_sharded(
+                        order, p, args.verify_with_v1_db, shards, cache, run_stats, data, failures
+                    )
+
+                return analyze_sim(p, args.verify_with_v1_db, mismatches, cache, run_stats, data, failures)
+            finally:
+                if prefetcher:
+                    prefetcher.release(data)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+            with tqdm.tqdm(total=0) as progress:
+                items = pending_items(progress)
+                for (_, p, _), (charts, digest) in run_bounded(executor, process_item, items, max_in_flight):
+                    # songs are added by the main thread only, so that checkpoints never see them half-added
+                    if not shards and charts is not None:
+                        storage.add_song(charts)
+                    record(p, charts, digest)
+                    progress.update()
+
+    if shards:
+        print("Merging worker shards")
+        with run_stats.timer("merge"):
+            merged = shards.merge_into(storage, mismatches)
+
+    print(f"Skipped {num_unchanged} unchanged or already saved simfiles")
+    run_stats.count("unchanged", num_unchanged)
+
+    with run_stats.timer("to_disk"):
+        storage.to_disk(args.db, writers=args.writers)
+    with run_stats.timer("manifest_save"):
+        manifest.to_disk(args.db)
+    if args.partition:
+        write_first_seen(args.db, merged.orders())
+    journal.remove()
 
     if args.verify_with_v1_db:
         pprint(mismatches)
 
+    if args.stats_json:
+        for name, count in failures.summary_dict().items():
+            run_stats.count(f"failures {name}", count)
+        run_stats.add_time("total", time.perf_counter() - start)
+        run_stats.to_disk(args.stats_json)
+
+
+def main():
+    parser = _get_parser()
+    args = parser.parse_args()
+
+    checkpoints = args.checkpoint_every > 0 or args.checkpoint_interval > 0
+    if args.partition:
+        if args.db.exists():
+            parser.error("partial dbs have to be generated from scratch")
+        if args.hash_only:
+            parser.error("--partition can't be used with --hash-only")
+        # the first occurrence of every chart has to be known to merge partial dbs
+        args.sharded = True
+
+    if checkpoints and args.sharded:
+        # worker shards are merged only once everything is processed, so there would be nothing to save
+        parser.error("checkpoints can't be used with --sharded")
+
+    if args.changesets and args.db_driver == "sqlite":
+        parser.error("changesets can't be used with the sqlite driver")
+
+    failures = FailureLog(args.failure_log, echo=args.verbose)
+    try:
+        run(args, failures)
+    finally:
+        failures.close()
+
+    if failures.summary:
+        # stdout may be the output of --hash-only
+        print("Failures:", file=sys.stderr)
+        for name, count in failures.summary_dict().items():
+            print(f"  {name}: {count}", file=sys.stderr)
+        if args.failure_log:
+            print(f"See {args.failure_log} for details", file=sys.stderr)
+
 
 if __name__ == "__main__":
     main()
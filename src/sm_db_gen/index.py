@@ -0,0 +1,139 @@
+import heapq
+import json
+import mmap
+import os
+import struct
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+from sm_db_gen.writer import CHART_SHARDS
+
+INDEX_FILENAME = "hashes.idx"
+INDEX_MAGIC = b"SMV2HIX1"
+INDEX_HEADER = struct.Struct("<8sQQ")  # magic, number of hashes, length of the trailer
+HASH_LENGTH = 16
+
+
+class HashIndex:
+    """Membership index of the json tree db: a sorted set of chart hashes that are stored in the db and the names of
+    known packs, so that misses are answered without touching the file system. The index describes the db as of its
+    `last_update` and is stale whenever it doesn't match `metadata.json`. Layout of the file:
+      header: magic, number of hashes, length of the trailer
+      hashes: fixed-width hashes sorted in ascending order
+      trailer: json with `last_update` of the db and sorted pack names
+
+    Hashes are memory-mapped and looked up with a binary search, pack names are kept in a set.
+    """
+
+    def __init__(self, hashes: bytes | mmap.mmap = b"", size: int = 0, packs: Iterable[str] = (), last_update=None):
+        self._hashes = hashes
+        self._size = size
+        self.packs = set(packs)
+        self.last_update = last_update
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, hash_v3: str) -> bool:
+        key = hash_v3.encode("ascii", "replace")
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo < self._size and self._key(lo) == key
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(self._size):
+            yield self._key(i).decode("ascii")
+
+    def _key(self, i: int) -> bytes:
+        start = INDEX_HEADER.size + i * HASH_LENGTH
+        return self._hashes[start : start + HASH_LENGTH]
+
+    def is_valid_for(self, metadata: dict) -> bool:
+        return (
+            self.last_update == metadata["last_update"]
+            and self._size == metadata["num_charts"]
+            and len(self.packs) == metadata["num_packs"]
+        )
+
+    @classmethod
+    def from_disk(cls, path: Path) -> "HashIndex | None":
+        try:
+            with open(path / INDEX_FILENAME, "rb") as f:
+                hashes = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, ValueError):
+            return None
+
+        magic, size, trailer_length = INDEX_HEADER.unpack_from(hashes, 0)
+        if magic != INDEX_MAGIC:
+            return None
+
+        trailer_offset = INDEX_HEADER.size + size * HASH_LENGTH
+        trailer = json.loads(hashes[trailer_offset : trailer_offset + trailer_length])
+
+        return cls(hashes, size, trailer["packs"], trailer["last_update"])
+
+    @classmethod
+    def from_files(cls, path: Path) -> "HashIndex":
+        """Lists the chart shard directories and the packs directory without reading any of the files."""
+        hashes = []
+        for shard in CHART_SHARDS:
+            hashes.extend(shard + name for name in _list_json_stems(path / "charts" / shard))
+        hashes = [h for h in hashes if len(h) == HASH_LENGTH]
+
+        packs = _list_json_stems(path / "packs")
+
+        index = cls()
+        index._hashes = b"".join([INDEX_HEADER.pack(INDEX_MAGIC, 0, 0)] + [h.encode("ascii") for h in sorted(hashes)])
+        index._size = len(hashes)
+        index.packs = set(packs)
+
+        return index
+
+    def to_disk(
+        self,
+        path: Path,
+        new_hashes: Iterable[str],
+        new_packs: Iterable[str],
+        last_update: str,
+        removed_hashes: Iterable[str] = (),
+        removed_packs: Iterable[str] = (),
+    ) -> "HashIndex":
+        """Writes the index extended with new hashes and packs, without the removed ones, and returns it opened from
+        the disk."""
+        removed_keys = {h.encode("ascii") for h in removed_hashes}
+        keys = heapq.merge(
+            (key for key in (self._key(i) for i in range(self._size)) if key not in removed_keys),
+            sorted({h.encode("ascii") for h in new_hashes if len(h) == HASH_LENGTH and h not in self}),
+        )
+        packs = self.packs.union(new_packs).difference(removed_packs)
+
+        index_path = path / INDEX_FILENAME
+        tmp_path = index_path.with_name(f".{index_path.name}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, 0, 0))
+            size = 0
+            for key in keys:
+                f.write(key)
+                size += 1
+
+            trailer = json.dumps({"last_update": last_update, "packs": sorted(packs)}).encode()
+            f.write(trailer)
+            f.seek(0)
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, size, len(trailer)))
+        os.replace(tmp_path, index_path)
+
+        return HashIndex.from_disk(path)
+
+
+def _list_json_stems(directory: Path) -> list[str]:
+    try:
+        with os.scandir(directory) as entries:
+            return [entry.name[: -len(".json")] for entry in entries if entry.name.endswith(".json")]
+    except FileNotFoundError:
+        return []
@@ -0,0 +1,124 @@
+import json
+import os
+from collections.abc import Callable, Iterable
+from contextlib import suppress
+from hashlib import sha1
+from pathlib import Path
+
+from sm_db_gen.writer import write_atomic
+
+MANIFEST_FILENAME = "manifest.json"
+JOURNAL_FILENAME = "journal.jsonl"
+
+
+def file_digest(p: Path) -> str:
+    return sha1(p.read_bytes(), usedforsecurity=False).hexdigest()
+
+
+class Manifest:
+    """Keeps track of simfiles that have already been processed into the db, so that unchanged files can be skipped
+    on the next run. Files are identified by their absolute path, size and modification time. Optionally, a digest
+    of the content is stored as well, so that touched but otherwise unchanged files are skipped too.
+
+    Example `manifest.json` entry:
+    "/path/to/Songs/pack/song/song.sm": {"hashes": ["023afbec6280c8b0", ...], "mtime_ns": 1729078692602603000, "size": 31337}
+    """
+
+    def __init__(self, use_digest: bool = False):
+        self._files = {}
+        self._use_digest = use_digest
+
+    def __len__(self):
+        return len(self._files)
+
+    @classmethod
+    def from_disk(cls, path: Path, use_digest: bool = False) -> "Manifest":
+        manifest = cls(use_digest=use_digest)
+
+        manifest_path = path / MANIFEST_FILENAME
+        if manifest_path.exists():
+            manifest._files = json.loads(manifest_path.read_text())["files"]
+
+        return manifest
+
+    def to_disk(self, path: Path):
+        write_atomic(path / MANIFEST_FILENAME, json.dumps({"files": self._files}, sort_keys=True))
+
+    @staticmethod
+    def _key(p: Path) -> str:
+        return os.fsdecode(p.absolute())
+
+    def is_unchanged(self, p: Path, stat: os.stat_result) -> bool:
+        entry = self._files.get(self._key(p))
+        if entry is None:
+            return False
+
+        if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return True
+
+        if self._use_digest and entry["size"] == stat.st_size and "sha1" in entry and entry["sha1"] == file_digest(p):
+            entry["mtime_ns"] = stat.st_mtime_ns
+            return True
+
+        return False
+
+    def update(self, p: Path, stat: os.stat_result, hashes: list[str], digest: str | None = None):
+        """`digest` is sha1 of the content if it's already known, otherwise the file is read again when digests are
+        used."""
+        entry = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "hashes": sorted(hashes),
+        }
+        if self._use_digest:
+            entry["sha1"] = digest or file_digest(p)
+
+        self._files[self._key(p)] = entry
+
+    def forget(self, predicate: Callable[[Path], bool]) -> int:
+        """Removes entries of simfiles matching the predicate, e.g. of a removed pack. Returns their number."""
+        forgotten = [key for key in self._files if predicate(Path(key))]
+        for key in forgotten:
+            del self._files[key]
+
+        return len(forgotten)
+
+
+class Journal:
+    """Simfiles whose results have already been saved by a checkpoint of a run that hasn't finished yet, so that
+    the run can be resumed with `--resume` even when the manifest is ignored. Every line is a json-encoded absolute
+    path. The journal is removed once the run finishes."""
+
+    def __init__(self, path: Path):
+        self._path = path / JOURNAL_FILENAME
+        self._completed = set()
+
+    def __len__(self):
+        return len(self._completed)
+
+    def __contains__(self, p: Path) -> bool:
+        return Manifest._key(p) in self._completed
+
+    @classmethod
+    def from_disk(cls, path: Path) -> "Journal":
+        journal = cls(path)
+        if journal._path.exists():
+            with open(journal._path) as f:
+                for line in f:
+                    with suppress(ValueError):  # the last line might have been cut short by a crash
+                        journal._completed.add(json.loads(line))
+
+        return journal
+
+    def append(self, paths: Iterable[Path]):
+        keys = [Manifest._key(p) for p in paths]
+        with open(self._path, "a") as f:
+            f.writelines(json.dumps(key) + "\n" for key in keys)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._completed.update(keys)
+
+    def remove(self):
+        self._path.unlink(missing_ok=True)
+        self._completed.clear()
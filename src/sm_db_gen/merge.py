@@ -0,0 +1,134 @@
+import argparse
+import json
+import zlib
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+from sm_db_gen.db import STORAGE_DRIVERS, SQLiteStorage, StorageShard
+from sm_db_gen.discovery import iter_simfiles
+from sm_db_gen.failures import NO_FAILURES, FailureBuffer
+from sm_db_gen.verify import iter_v2_charts
+from sm_db_gen.writer import DEFAULT_WRITERS, write_atomic
+
+FIRST_SEEN_FILENAME = "first_seen.json"
+PARTITION_MODES = ("pack", "path")
+
+
+def parse_partition(value: str) -> tuple[int, int]:
+    """Parses `INDEX/COUNT`, e.g. `2/4`. Indices start at 1."""
+    try:
+        index, count = map(int, value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected INDEX/COUNT, got {value!r}")
+
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"index has to be between 1 and {count}, got {index}")
+
+    return index, count
+
+
+def discovery_order_key(roots: list[Path], p: Path) -> tuple:
+    """Key that sorts simfiles in the order in which `iter_simfiles(roots)` finds them, but can be computed for every
+    simfile on its own, e.g. on another machine: the index of the root followed by the path components, where files
+    go before directories on the same level."""
+    for i, root in enumerate(roots):
+        if p == root:
+            return (i,)
+
+        try:
+            parts = p.relative_to(root).parts
+        except ValueError:
+            continue
+
+        return (i, *(f"1{part}" for part in parts[:-1]), f"0{parts[-1]}")
+
+    raise ValueError(f"{p} is not in any of {roots}")
+
+
+def get_partition_key(roots: list[Path], p: Path, by: str) -> str:
+    if by == "pack":
+        return p.parent.parent.name
+
+    for root in roots:
+        try:
+            return p.relative_to(root).as_posix()
+        except ValueError:
+            continue
+
+    return p.as_posix()
+
+
+def iter_partition(
+    roots: list[Path], partition: tuple[int, int], by: str, failures: FailureBuffer = NO_FAILURES
+) -> Iterator[Path]:
+    """Yields simfiles of the partition. Keys of partitions are hashed, so partitions get roughly equal numbers of
+    packs or simfiles regardless of their names."""
+    index, count = partition
+    for p in iter_simfiles(roots, failures):
+        key = get_partition_key(roots, p, by)
+        if zlib.crc32(key.encode("utf-8", "surrogateescape")) % count == index - 1:
+            yield p
+
+
+def read_first_seen(path: Path) -> dict[str, list]:
+    return json.loads((path / FIRST_SEEN_FILENAME).read_text())
+
+
+def write_first_seen(path: Path, orders: dict[str, tuple]):
+    """Saves the discovery order key of the simfile every chart was first seen in, the one the chart's metadata comes
+    from."""
+    write_atomic(path / FIRST_SEEN_FILENAME, json.dumps(orders, sort_keys=True))
+
+
+def merge_dbs(paths: Iterable[Path]) -> StorageShard:
+    """Merges partial dbs into a single shard. The metadata of every chart comes from the db that saw it first in the
+    discovery order, so the result doesn't depend on the order of the dbs and it's the same as if all the simfiles
+    were processed with `sm-db-gen --sharded` by a single run."""
+    merged = StorageShard()
+    for path in paths:
+        print(f"Merging {path}")
+        first_seen = read_first_seen(path)
+        for chart in iter_v2_charts(path):
+            merged.add_chart(first_seen[chart.hash], chart)
+
+    return merged
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="Merges partial dbs generated with `sm-db-gen --partition` into a single db",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("partials", type=Path, nargs="+", help="Paths to the partial dbs", metavar="PARTIAL")
+    parser.add_argument("--db", type=Path, default=Path("db_v2"), help="Path to the output db directory")
+    parser.add_argument("--db-driver", choices=STORAGE_DRIVERS, default="inmem", help="Driver for saving the output db")
+    parser.add_argument("--writers", type=int, default=DEFAULT_WRITERS, help="Number of threads used to save the db")
+
+    return parser
+
+
+def main():
+    parser = _get_parser()
+    args = parser.parse_args()
+
+    if args.db.exists():
+        parser.error(f"{args.db} already exists")
+    for path in args.partials:
+        if not (path / FIRST_SEEN_FILENAME).exists():
+            parser.error(f"{path} has no {FIRST_SEEN_FILENAME}, it wasn't generated with --partition")
+
+    merged = merge_dbs(args.partials)
+
+    driver = STORAGE_DRIVERS[args.db_driver]
+    storage = SQLiteStorage.create(args.db) if driver is SQLiteStorage else driver()
+    merged.save(storage)
+    storage.to_disk(args.db, writers=args.writers)
+    # the merged db can be merged further
+    write_first_seen(args.db, merged.orders())
+
+    print("Packs:", storage.num_packs)
+    print("Charts:", storage.num_charts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+from pathlib import Path
+
+
+def get_pack_name(path: Path) -> str:
+    """Simfiles are stored in `<pack>/<song>/`."""
+    return get_pack_dir_name(path.parent.parent)
+
+
+def get_pack_dir_name(pack_dir: Path) -> str:
+    return pack_dir.name.encode("utf-8", "ignore").decode("utf-8")
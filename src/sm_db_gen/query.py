@@ -0,0 +1,281 @@
+import argparse
+import contextlib
+import http.server
+import json
+import sys
+import threading
+from collections.abc import Iterable
+from pathlib import Path
+from urllib.parse import parse_qs, unquote
+
+from sm_db_gen.cache import MISSING, LRUCache
+from sm_db_gen.db import STORAGE_DRIVERS, SQLiteStorage, StorageV2
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_PORT = 8372
+MAX_REQUEST_SIZE = 16 * 2**20
+
+SEARCH_CRITERIA = ("title", "artist", "steps_type", "diff", "diff_number")
+
+
+class ChartQuery:
+    """Read-only lookups of charts by hash and of pack listings. Recently used charts and pack listings, including the
+    missing ones, are kept in an LRU cache. Before every batch of lookups `last_update` of the db is checked and if the
+    db has been saved since it was loaded, the db is loaded again and the cache is cleared."""
+
+    def __init__(self, path: Path, driver: type[StorageV2], cache_size: int = DEFAULT_CACHE_SIZE):
+        self._path = path
+        self._driver = driver
+        self._charts = LRUCache(cache_size)  # hash -> json-ready dict or None
+        self._packs = LRUCache(cache_size)  # pack -> tuple of hashes
+        self._lock = threading.Lock()
+        self._storage = None
+        self._last_update = None
+
+    def _get_storage(self) -> StorageV2:
+        with self._lock:
+            last_update = self._driver.read_last_update(self._path)
+            if self._storage is None or last_update != self._last_update:
+                if self._storage is not None:
+                    print(f"The db has been updated at {last_update}, reloading", file=sys.stderr)
+                # drivers report e.g. rebuilding of their indexes, which must not get mixed with the results
+                with contextlib.redirect_stdout(sys.stderr):
+                    self._storage = self._driver.from_disk(self._path)
+                self._last_update = last_update
+                self._charts.clear()
+                self._packs.clear()
+
+            return self._storage
+
+    @staticmethod
+    def _to_dict(chart) -> dict | None:
+        return chart and json.loads(chart.to_json())
+
+    def _get_chart(self, storage: StorageV2, hash_v3: str) -> dict | None:
+        chart = self._charts.get(hash_v3)
+        if chart is MISSING:
+            chart = self._to_dict(storage.get_chart(hash_v3))
+            self._charts.put(hash_v3, chart)
+
+        return chart
+
+    def _get_pack(self, storage: StorageV2, pack: str) -> list[dict]:
+        hashes = self._packs.get(pack)
+        if hashes is not MISSING:
+            return [chart for hash in hashes if (chart := self._get_chart(storage, hash)) is not None]
+
+        charts = [self._to_dict(chart) for chart in storage.get_charts(pack)]
+        for chart in charts:
+            self._charts.put(chart["hash"], chart)
+        self._packs.put(pack, tuple(chart["hash"] for chart in charts))
+
+        return charts
+
+    def get_charts(self, hashes: Iterable[str]) -> dict[str, dict | None]:
+        storage = self._get_storage()
+        return {hash_v3: self._get_chart(storage, hash_v3) for hash_v3 in hashes}
+
+    def get_packs(self, packs: Iterable[str]) -> dict[str, list[dict]]:
+        """Unknown packs have no charts."""
+        storage = self._get_storage()
+        return {pack: self._get_pack(storage, pack) for pack in packs}
+
+    def search(self, **criteria) -> list[dict]:
+        """Charts matching the criteria of `StorageV2.search`, in the order of their hashes."""
+        storage = self._get_storage()
+        return [self._get_chart(storage, hash_v3) for hash_v3 in storage.search(**criteria)]
+
+
+class QueryRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Endpoints:
+    GET /charts/<hash>  - a chart or 404
+    GET /packs/<name>   - a list of charts of the pack
+    GET /search?title=...&artist=...&steps_type=...&diff=...&diff_number=...
+                        - a list of charts matching all the given criteria
+    POST /batch         - {"hashes": [...], "packs": [...]} -> {"charts": {hash: chart or null}, "packs": {name: [...]}}
+    """
+
+    server: "QueryServer"
+
+    def _send_json(self, value, status: int = 200):
+        body = json.dumps(value, sort_keys=True).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str):
+        self._send_json({"error": message}, status)
+
+    def do_GET(self):
+        path, _, query_string = self.path.partition("?")
+        kind, _, key = path.lstrip("/").partition("/")
+        key = unquote(key)
+
+        if kind == "search" and not key:
+            try:
+                criteria = parse_criteria(parse_qs(query_string))
+            except ValueError as e:
+                self._send_error(400, f"Invalid request: {e}")
+            else:
+                self._send_json(self.server.query.search(**criteria))
+        elif kind == "charts" and key:
+            chart = self.server.query.get_charts([key])[key]
+            if chart is None:
+                self._send_error(404, f"Chart {key} is not in the db")
+            else:
+                self._send_json(chart)
+        elif kind == "packs" and key:
+            self._send_json(self.server.query.get_packs([key])[key])
+        else:
+            self._send_error(404, f"Unknown endpoint {self.path}")
+
+    def do_POST(self):
+        if self.path.partition("?")[0] != "/batch":
+            self._send_error(404, f"Unknown endpoint {self.path}")
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST_SIZE:
+            self._send_error(413, f"Request is bigger than {MAX_REQUEST_SIZE} bytes")
+            return
+
+        try:
+            request = json.loads(self.rfile.read(length))
+            hashes = request.get("hashes", [])
+            packs = request.get("packs", [])
+            if not isinstance(hashes, list) or not isinstance(packs, list):
+                raise TypeError("hashes and packs have to be lists")
+            if not all(isinstance(key, str) for key in [*hashes, *packs]):
+                raise TypeError("hashes and packs have to be lists of strings")
+        except (ValueError, TypeError, AttributeError) as e:
+            self._send_error(400, f"Invalid request: {e}")
+            return
+
+        self._send_json({"charts": self.server.query.get_charts(hashes), "packs": self.server.query.get_packs(packs)})
+
+
+class QueryServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], query: ChartQuery):
+        super().__init__(address, QueryRequestHandler)
+        self.query = query
+
+
+def parse_criteria(query: dict[str, list[str]]) -> dict:
+    criteria = {field: values[-1] for field, values in query.items() if field in SEARCH_CRITERIA}
+    if "diff_number" in criteria:
+        criteria["diff_number"] = int(criteria["diff_number"])
+    if not criteria:
+        raise ValueError(f"at least one of {', '.join(SEARCH_CRITERIA)} is required")
+
+    return criteria
+
+
+def read_keys(keys: list[str], input_paths: list[str]) -> list[str]:
+    """Keys given as arguments followed by the non-empty lines of input files, `-` stands for stdin."""
+    keys = list(keys)
+    for input_path in input_paths:
+        if input_path == "-":
+            lines = sys.stdin.read().splitlines()
+        else:
+            lines = Path(input_path).read_text().splitlines()
+        keys.extend(line.strip() for line in lines if line.strip())
+
+    return keys
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="Looks up charts by their hashes or packs by their names and prints json lines. Can also run as "
+        "a local http service, see --serve",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("keys", nargs="*", help="Hashes of charts or, with --pack, names of packs", metavar="KEY")
+    parser.add_argument(
+        "--input",
+        action="append",
+        default=[],
+        help="Read additional keys from this file, one per line. Use - for stdin. Can be repeated",
+        metavar="FILE",
+    )
+    parser.add_argument("--pack", action="store_true", help="Keys are names of packs instead of chart hashes")
+    parser.add_argument("--db", type=Path, default=Path("db_v2"), help="Path to the db directory")
+    parser.add_argument(
+        "--db-driver", choices=STORAGE_DRIVERS, default="lazy", help="Driver for interacting with the db"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help="Number of charts and, separately, of pack listings kept in memory",
+    )
+    parser.add_argument(
+        "--serve",
+        nargs="?",
+        const=DEFAULT_PORT,
+        type=int,
+        help="Instead of looking up the keys, serve lookups over http on this port",
+        metavar="PORT",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Address to bind with --serve")
+
+    search = parser.add_argument_group(
+        "search", "Instead of looking up the keys, print charts that match all the given criteria"
+    )
+    search.add_argument("--title", help="Words of the title or its transliteration")
+    search.add_argument("--artist", help="Words of the artist or its transliteration")
+    search.add_argument("--steps-type", help="e.g. dance-single")
+    search.add_argument("--diff", help="e.g. Challenge")
+    search.add_argument("--diff-number", type=int, help="Meter of the chart")
+
+    return parser
+
+
+def main():
+    parser = _get_parser()
+    args = parser.parse_args()
+
+    driver = STORAGE_DRIVERS[args.db_driver]
+    if driver is SQLiteStorage and not (args.db / SQLiteStorage.FILENAME).exists():
+        parser.error(f"{args.db / SQLiteStorage.FILENAME} doesn't exist")
+    if not (args.db / "metadata.json").exists() and driver is not SQLiteStorage:
+        parser.error(f"{args.db} is not a db")
+
+    query = ChartQuery(args.db, driver, args.cache_size)
+
+    criteria = {field: getattr(args, field) for field in SEARCH_CRITERIA if getattr(args, field) is not None}
+
+    if args.serve is not None:
+        if args.keys or args.input or criteria:
+            parser.error("keys and search criteria can't be used with --serve")
+
+        with QueryServer((args.host, args.serve), query) as server:
+            print(f"Serving {args.db} on http://{args.host}:{server.server_port}", file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+        return
+
+    if criteria:
+        if args.keys or args.input:
+            parser.error("keys can't be used with search criteria")
+
+        for chart in query.search(**criteria):
+            print(json.dumps({"hash": chart["hash"], "chart": chart}, sort_keys=True))
+        return
+
+    keys = read_keys(args.keys, args.input or ([] if args.keys else ["-"]))
+    if args.pack:
+        for pack, charts in query.get_packs(keys).items():
+            print(json.dumps({"pack": pack, "charts": charts}, sort_keys=True))
+    else:
+        for hash_v3, chart in query.get_charts(keys).items():
+            print(json.dumps({"hash": hash_v3, "chart": chart}, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
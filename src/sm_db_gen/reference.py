@@ -1,6 +1,17 @@
+import argparse
 import json
+import mmap
+import os
+import struct
+from collections.abc import Iterator
+from functools import lru_cache
 from pathlib import Path
 
+INDEX_MAGIC = b"SMV1IDX1"
+INDEX_HEADER = struct.Struct("<8sQ")  # magic, number of entries
+INDEX_ENTRY = struct.Struct("<16sQI")  # hash, offset of the record in the blob, length of the record
+HASH_LENGTH = 16
+
 
 def get_v1_reference(v1_db_root: Path, hash_v3: str) -> dict | None:
     """V1 of the chart db database used the following 2-level file-system layout:
@@ -24,5 +35,152 @@ def get_v1_reference(v1_db_root: Path, hash_v3: str) -> dict | None:
     if not reference_path.exists():
         return None
 
+    return _load_v1_reference(reference_path.read_bytes())
+
+
+def _load_v1_reference(raw: bytes) -> dict:
     # see rationale behind replace: https://github.com/florczakraf/stepmania-chart-db-generator/issues/3
-    return json.loads(reference_path.read_bytes().decode("utf8", errors="replace").replace("\\\\", ""))
+    return json.loads(raw.decode("utf8", errors="replace").replace("\\\\", ""))
+
+
+def build_v1_index(v1_db_root: Path, index_path: Path) -> int:
+    """Compacts the v1 db into a single index file, so that references can be looked up without touching the file
+    system. Layout of the file:
+      header: magic, number of entries
+      entries: fixed-width hash keys sorted in ascending order, each with an offset and a length of its record
+      blob: records, i.e. references already normalized by `_load_v1_reference` and dumped as compact json
+
+    Returns the number of indexed references.
+    """
+    records = []
+    for shard_dir in sorted(v1_db_root.iterdir()):
+        if not shard_dir.is_dir():
+            continue
+
+        for reference_path in shard_dir.glob("*.json"):
+            hash_v3 = shard_dir.name + reference_path.stem
+            if len(hash_v3) != HASH_LENGTH:
+                print(f"{reference_path}: Unexpected hash length, skipping it")
+                continue
+
+            reference = _load_v1_reference(reference_path.read_bytes())
+            records.append((hash_v3.encode("ascii"), json.dumps(reference, separators=(",", ":")).encode()))
+
+    records.sort()
+
+    entries = []
+    blob = []
+    offset = 0
+    for key, record in records:
+        entries.append(INDEX_ENTRY.pack(key, offset, len(record)))
+        blob.append(record)
+        offset += len(record)
+
+    tmp_path = index_path.with_name(f".{index_path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(records)))
+        f.writelines(entries)
+        f.writelines(blob)
+    os.replace(tmp_path, index_path)
+
+    return len(records)
+
+
+class V1ReferenceIndex:
+    """Read-only view of the index created by `build_v1_index`. The file is memory-mapped and looked up with a binary
+    search, so lookups don't need any syscalls."""
+
+    def __init__(self, index_path: Path):
+        with open(index_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._size = INDEX_HEADER.unpack_from(self._mmap, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{index_path} is not a v1 reference index")
+
+        self._entries_offset = INDEX_HEADER.size
+        self._blob_offset = self._entries_offset + self._size * INDEX_ENTRY.size
+
+    def __len__(self):
+        return self._size
+
+    def _key(self, i: int) -> bytes:
+        start = self._entries_offset + i * INDEX_ENTRY.size
+        return self._mmap[start : start + HASH_LENGTH]
+
+    def _record(self, i: int) -> tuple[bytes, dict]:
+        key, offset, length = INDEX_ENTRY.unpack_from(self._mmap, self._entries_offset + i * INDEX_ENTRY.size)
+        start = self._blob_offset + offset
+
+        return key, json.loads(self._mmap[start : start + length])
+
+    def items(self) -> Iterator[tuple[str, dict]]:
+        for i in range(self._size):
+            key, reference = self._record(i)
+            yield key.decode("ascii"), reference
+
+    def get(self, hash_v3: str) -> dict | None:
+        key = hash_v3.encode("ascii")
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == self._size or self._key(lo) != key:
+            return None
+
+        return self._record(lo)[1]
+
+
+@lru_cache
+def _open_v1_index(v1_db: Path) -> V1ReferenceIndex | None:
+    return V1ReferenceIndex(v1_db) if v1_db.is_file() else None
+
+
+def lookup_v1_reference(v1_db: Path, hash_v3: str) -> dict | None:
+    """`v1_db` is either the v1 db directory or an index built from it with `sm-db-v1-index`."""
+    index = _open_v1_index(v1_db)
+    if index is None:
+        return get_v1_reference(v1_db, hash_v3)
+
+    return index.get(hash_v3)
+
+
+def iter_v1_references(v1_db: Path) -> Iterator[tuple[str, dict]]:
+    """Yields `(hash, reference)` pairs in hash order from the v1 db directory or its index."""
+    index = _open_v1_index(v1_db)
+    if index is not None:
+        yield from index.items()
+        return
+
+    for shard_dir in sorted(v1_db.iterdir()):
+        if not shard_dir.is_dir():
+            continue
+
+        for reference_path in sorted(shard_dir.glob("*.json")):
+            yield shard_dir.name + reference_path.stem, _load_v1_reference(reference_path.read_bytes())
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="Compacts v1 db into a single index file that can be passed to --verify-with-v1-db",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("v1_db", type=Path, help="Path to the v1 db directory", metavar="V1_DB")
+    parser.add_argument("output", type=Path, help="Path to the output index file", metavar="OUTPUT")
+
+    return parser
+
+
+def main():
+    args = _get_parser().parse_args()
+
+    num_references = build_v1_index(args.v1_db, args.output)
+    print(f"Indexed {num_references} references")
+
+
+if __name__ == "__main__":
+    main()
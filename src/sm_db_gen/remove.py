@@ -0,0 +1,65 @@
+import argparse
+from pathlib import Path
+
+from sm_db_gen.changeset import Changeset
+from sm_db_gen.db import STORAGE_DRIVERS
+from sm_db_gen.manifest import Manifest
+from sm_db_gen.packs import get_pack_name
+from sm_db_gen.writer import DEFAULT_WRITERS
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="Removes packs from the db. Only charts of the removed packs are touched, the ones that don't "
+        "belong to any other pack are removed as well",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("packs", nargs="+", help="Name(s) of the pack(s) to remove", metavar="PACK")
+    parser.add_argument("--db", type=Path, default=Path("db_v2"), help="Path to the db directory")
+    parser.add_argument(
+        "--db-driver", choices=STORAGE_DRIVERS, default="lazy", help="Driver for interacting with the db"
+    )
+    parser.add_argument(
+        "--changesets",
+        type=Path,
+        help="Write an archive with the changed files to this directory, see `sm-db-gen --changesets`",
+        metavar="DIR",
+    )
+    parser.add_argument("--writers", type=int, default=DEFAULT_WRITERS, help="Number of threads used to save the db")
+
+    return parser
+
+
+def main():
+    parser = _get_parser()
+    args = parser.parse_args()
+
+    if not args.db.exists():
+        parser.error(f"{args.db} doesn't exist")
+
+    if args.changesets and args.db_driver == "sqlite":
+        parser.error("changesets can't be used with the sqlite driver")
+
+    storage = STORAGE_DRIVERS[args.db_driver].from_disk(args.db)
+    if args.changesets:
+        storage.changeset = Changeset(args.changesets, storage.read_last_update(args.db))
+    manifest = Manifest.from_disk(args.db)
+
+    for pack in args.packs:
+        updated, removed = storage.remove_pack(pack, writers=args.writers)
+        if not updated and not removed:
+            print(f"Pack {pack} is not in the db")
+            continue
+
+        print(f"Removed pack {pack}: {updated} charts updated, {removed} charts removed")
+        manifest.forget(lambda p: get_pack_name(p) == pack)
+
+    storage.to_disk(args.db, writers=args.writers)
+    manifest.to_disk(args.db)
+
+    print("Packs:", storage.num_packs)
+    print("Charts:", storage.num_charts)
+
+
+if __name__ == "__main__":
+    main()
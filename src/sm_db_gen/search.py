@@ -0,0 +1,187 @@
+import json
+import re
+import shutil
+import zlib
+from collections import defaultdict
+from collections.abc import Callable, Iterable, Iterator
+from pathlib import Path
+
+from sm_db_gen.writer import DEFAULT_WRITERS, run_parallel, write_atomic
+
+SEARCH_DIRNAME = "search"
+SEARCH_FIELDS = {
+    # field: (chart attributes, number of buckets)
+    "title": (("title", "titletranslit"), 4096),
+    "artist": (("artist", "artisttranslit"), 4096),
+    "type": (("steps_type", "diff", "diff_number"), 256),
+}
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def normalize_text(value: str) -> str:
+    return value.lower().replace("[", "(").replace("]", ")").replace("~", "-")
+
+
+def tokenize(value: str) -> set[str]:
+    """Splits the text into words after the same normalization that is used when verifying against the v1 db."""
+    return set(TOKEN_PATTERN.findall(normalize_text(value)))
+
+
+def type_key(steps_type: str, diff: str, diff_number) -> str:
+    return f"{steps_type}:{diff}:{diff_number}"
+
+
+def chart_search_keys(chart) -> Iterable[tuple[str, str]]:
+    """Yields `(field, key)` pairs under which the chart can be found."""
+    for field in ("title", "artist"):
+        tokens = set()
+        for attribute in SEARCH_FIELDS[field][0]:
+            tokens.update(tokenize(getattr(chart, attribute)))
+        for token in tokens:
+            yield field, token
+
+    yield "type", type_key(chart.steps_type, chart.diff, chart.diff_number)
+
+
+def _read_json(path: Path, default):
+    try:
+        return json.loads(path.read_text())
+    except IOError:
+        return default
+
+
+class SearchIndex:
+    """Secondary indexes of the json tree db: words of titles and artists (including their transliterations) and
+    `(steps_type, diff, diff_number)` of charts, each mapped to sorted hashes of the matching charts. Keys are spread
+    over bucket files by their crc32, so that a lookup reads a single small file and an update rewrites only the
+    buckets of the touched charts. Layout:
+      search/
+        metadata.json      `last_update` of the db the index was saved with
+        title/000.json     {"word": ["hash", ...], ...}
+        artist/000.json
+        type/00.json       {"dance-single:Hard:9": ["hash", ...], ...}
+
+    Like the hash index, it's stale whenever its `last_update` doesn't match `metadata.json` of the db, e.g. because
+    a save has been interrupted. A stale index is rebuilt from scratch by the next save.
+    """
+
+    def __init__(self, path: Path):
+        self._path = path / SEARCH_DIRNAME
+
+    @property
+    def last_update(self) -> str | None:
+        return _read_json(self._path / "metadata.json", {}).get("last_update")
+
+    def is_valid_for(self, db_path: Path) -> bool:
+        return self.last_update == _read_json(db_path / "metadata.json", {}).get("last_update")
+
+    def _bucket_path(self, field: str, key: str) -> Path:
+        buckets = SEARCH_FIELDS[field][1]
+        bucket = zlib.crc32(key.encode("utf-8", "surrogateescape")) % buckets
+        return self._path / field / f"{bucket:0{len(f'{buckets - 1:x}')}x}.json"
+
+    def lookup(self, field: str, key: str) -> set[str]:
+        return set(_read_json(self._bucket_path(field, key), {}).get(key, ()))
+
+    def _lookup_all(self, field: str, keys: Iterable[str]) -> set[str] | None:
+        """Intersection of the postings of all the keys, `None` if there are no keys."""
+        result = None
+        for key in keys:
+            hashes = self.lookup(field, key)
+            result = hashes if result is None else result & hashes
+            if not result:
+                break
+
+        return result
+
+    def iter_postings(self, field: str) -> Iterator[tuple[str, list[str]]]:
+        for bucket_path in (self._path / field).glob("*.json"):
+            yield from _read_json(bucket_path, {}).items()
+
+    def _lookup_types(self, steps_type: str | None, diff: str | None, diff_number: int | None) -> set[str]:
+        if None not in (steps_type, diff, diff_number):
+            return self.lookup("type", type_key(steps_type, diff, diff_number))
+
+        # a partial type has to be matched against all the keys
+        result = set()
+        for key, hashes in self.iter_postings("type"):
+            key_steps_type, key_diff, key_diff_number = key.rsplit(":", 2)
+            if (
+                steps_type in (None, key_steps_type)
+                and diff in (None, key_diff)
+                and diff_number in (None, int(key_diff_number))
+            ):
+                result.update(hashes)
+
+        return result
+
+    def search(
+        self,
+        title: str | None = None,
+        artist: str | None = None,
+        steps_type: str | None = None,
+        diff: str | None = None,
+        diff_number: int | None = None,
+    ) -> list[str]:
+        """Returns sorted hashes of charts that match all the given criteria. Titles and artists match when they
+        contain all the words of the query. Lookups by a full `(steps_type, diff, diff_number)` read a single bucket,
+        partial ones read all of them."""
+        result = None
+        for field, value in (("title", title), ("artist", artist)):
+            if value is not None:
+                hashes = self._lookup_all(field, tokenize(value))
+                result = hashes if result is None else result & (hashes or set())
+
+        if (steps_type, diff, diff_number) != (None, None, None) and result != set():
+            hashes = self._lookup_types(steps_type, diff, diff_number)
+            result = hashes if result is None else result & hashes
+
+        return sorted(result or ())
+
+    def to_disk(
+        self,
+        added: Iterable,
+        removed: Iterable,
+        last_update: str,
+        all_charts: Callable[[], Iterable],
+        writers: int = DEFAULT_WRITERS,
+    ):
+        """Removes keys of the removed charts and adds keys of the added ones. Has to be called before `metadata.json`
+        of the db is saved. If the index is stale, e.g. when it's missing in a db created by an older version, it's
+        rebuilt from `all_charts()` instead."""
+        changes = defaultdict(dict)  # bucket path -> key -> (added hashes, removed hashes)
+
+        def collect(charts, i):
+            for chart in charts:
+                for field, key in chart_search_keys(chart):
+                    bucket = changes[self._bucket_path(field, key)]
+                    bucket.setdefault(key, (set(), set()))[i].add(chart.hash)
+
+        if not self.is_valid_for(self._path.parent):
+            print("Search index is missing or stale, rebuilding it")
+            shutil.rmtree(self._path, ignore_errors=True)
+            collect(all_charts(), 0)
+        else:
+            collect(removed, 1)
+            collect(added, 0)
+
+        for field in SEARCH_FIELDS:
+            (self._path / field).mkdir(parents=True, exist_ok=True)
+
+        def save_bucket(item):
+            bucket_path, bucket_changes = item
+            postings = _read_json(bucket_path, {})
+            for key, (added_hashes, removed_hashes) in bucket_changes.items():
+                hashes = set(postings.get(key, ())).difference(removed_hashes).union(added_hashes)
+                if hashes:
+                    postings[key] = sorted(hashes)
+                else:
+                    postings.pop(key, None)
+
+            if postings:
+                write_atomic(bucket_path, json.dumps(postings, sort_keys=True))
+            else:
+                bucket_path.unlink(missing_ok=True)
+
+        run_parallel(save_bucket, changes.items(), writers)
+        write_atomic(self._path / "metadata.json", json.dumps({"last_update": last_update}))
@@ -0,0 +1,144 @@
+import contextlib
+import heapq
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+from sm_db_gen.writer import write_atomic
+
+DEFAULT_TOP_N = 20
+
+
+class RunStats:
+    """Cumulative wall time and number of calls of every stage of a run, per-file latency histogram with power of two
+    millisecond buckets, the slowest simfiles and the number of simfiles that needed each fallback of `load_simfile`.
+
+    Times of stages that run in workers are summed over all the workers, so they can exceed the wall time of the run.
+    Stats collected in worker processes are sent back to the parent and merged there.
+    """
+
+    def __init__(self, top_n: int = DEFAULT_TOP_N):
+        self._lock = threading.Lock()
+        self.top_n = top_n
+        self.stages = {}
+        self.fallbacks = Counter()
+        self.counters = Counter()
+        self.latency_histogram = Counter()
+        self.slowest = []  # min-heap of (seconds, path)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add_time(self, stage: str, seconds: float, count: int = 1):
+        with self._lock:
+            total = self.stages.setdefault(stage, [0.0, 0])
+            total[0] += seconds
+            total[1] += count
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed(self, items: Iterable, stage: str) -> Iterator:
+        """Yields from `items` and counts the time spent on producing every item towards the `stage`."""
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(stage, time.perf_counter() - start)
+
+            yield item
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def count_fallback(self, level: str):
+        with self._lock:
+            self.fallbacks[level] += 1
+
+    def add_file(self, p: Path, seconds: float):
+        bucket = 2 ** max(0, math.ceil(math.log2(max(seconds * 1000, 1))))
+        with self._lock:
+            self.latency_histogram[bucket] += 1
+            self._push_slowest(seconds, os.fspath(p))
+
+    def _push_slowest(self, seconds: float, path: str):
+        if len(self.slowest) < self.top_n:
+            heapq.heappush(self.slowest, (seconds, path))
+        else:
+            heapq.heappushpop(self.slowest, (seconds, path))
+
+    def merge(self, other: "RunStats"):
+        with self._lock:
+            for stage, (seconds, count) in other.stages.items():
+                total = self.stages.setdefault(stage, [0.0, 0])
+                total[0] += seconds
+                total[1] += count
+
+            self.fallbacks.update(other.fallbacks)
+            self.counters.update(other.counters)
+            self.latency_histogram.update(other.latency_histogram)
+            for seconds, path in other.slowest:
+                self._push_slowest(seconds, path)
+
+    def to_dict(self) -> dict:
+        return {
+            "stages": {stage: {"seconds": seconds, "count": count} for stage, (seconds, count) in self.stages.items()},
+            "load_simfile_fallbacks": dict(self.fallbacks),
+            "counters": dict(self.counters),
+            "latency_histogram_ms": [
+                {"le": bucket, "count": self.latency_histogram[bucket]} for bucket in sorted(self.latency_histogram)
+            ],
+            "slowest": [{"path": path, "seconds": seconds} for seconds, path in sorted(self.slowest, reverse=True)],
+        }
+
+    def to_disk(self, path: Path):
+        write_atomic(path, json.dumps(self.to_dict(), indent=2))
+
+
+class NullStats(RunStats):
+    """Drop-in replacement that doesn't collect anything, used when stats weren't requested."""
+
+    def add_time(self, stage: str, seconds: float, count: int = 1):
+        pass
+
+    def timer(self, stage: str):
+        return contextlib.nullcontext()
+
+    def timed(self, items: Iterable, stage: str) -> Iterable:
+        return items
+
+    def count(self, name: str, n: int = 1):
+        pass
+
+    def count_fallback(self, level: str):
+        pass
+
+    def add_file(self, p: Path, seconds: float):
+        pass
+
+    def merge(self, other: RunStats):
+        pass
+
+
+NO_STATS = NullStats()
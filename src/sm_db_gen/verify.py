@@ -0,0 +1,161 @@
+import argparse
+import json
+import sqlite3
+from collections import Counter
+from collections.abc import Iterator
+from pathlib import Path
+from pprint import pprint
+
+from sm_db_gen.db import Chart, SQLiteStorage
+from sm_db_gen.reference import iter_v1_references
+from sm_db_gen.search import normalize_text
+
+TOLERATED_FIELDS = (
+    "diff_number",  # usually happens in case of DDR/X/ITG mismatches
+    "pack_name",
+    "subtitle",  # sometimes used for tech
+    "diff",  # tournaments started to change this so that all songs align nicely
+)
+TEXT_FIELDS = (
+    "title",
+    "directory",
+    "artist",
+    "titletranslit",
+    "artisttranslit",
+)
+
+
+def compare_with_reference(chart: Chart, reference: dict, mismatches: Counter) -> list[tuple[str, object, object]]:
+    """Compares the chart with its v1 counterpart. Known and acceptable kinds of differences are only counted in
+    `mismatches`, the remaining ones are returned as `(field, ref, new)`."""
+    differences = []
+
+    for k in reference.keys():
+        ref = reference[k]
+        new = getattr(chart, k)
+        if ref == new:
+            continue
+
+        if k in TOLERATED_FIELDS:
+            mismatches[k] += 1
+            continue
+
+        if k == "steps_type":
+            if sorted([ref, new]) == sorted(["dance-couple", "dance-double"]):
+                mismatches["couple/double"] += 1
+                continue
+
+        if k in TEXT_FIELDS:
+            ref = normalize_text(ref)
+            new = normalize_text(new)
+
+            if (ref in new) or (
+                new in ref
+            ):  # usually happens in case of prefixing with tiers in tournaments or "feat."
+                mismatches["contains_" + k] += 1
+                continue
+            if k == "directory":
+                mismatches[k] += 1
+                continue
+
+        differences.append((k, ref, new))
+
+    return differences
+
+
+def format_differences(differences: list[tuple[str, object, object]]) -> str:
+    buf = ""
+    for k, ref, new in differences:
+        buf += f"\t{k}:\n"
+        buf += f"\t\tRef: {ref}\n"
+        buf += f"\t\tNew: {new}\n"
+        buf += "\n"
+
+    return buf
+
+
+def iter_v2_charts(db: Path) -> Iterator[Chart]:
+    """Yields all charts of the v2 db in hash order, from the sqlite file if there's one or from the json tree."""
+    sqlite_path = db / SQLiteStorage.FILENAME
+    if sqlite_path.exists():
+        connection = sqlite3.connect(sqlite_path)
+        try:
+            for (data,) in connection.execute("SELECT data FROM charts ORDER BY hash"):
+                yield Chart(**json.loads(data))
+        finally:
+            connection.close()
+        return
+
+    for shard_dir in sorted((db / "charts").iterdir()):
+        for chart_path in sorted(shard_dir.glob("*.json")):
+            yield Chart(**json.loads(chart_path.read_text()))
+
+
+def verify(v2_charts: Iterator[Chart], v1_references: Iterator[tuple[str, dict]], report) -> Counter:
+    """Joins both dbs that are streamed in hash order and compares matching charts with the same rules that are used
+    by `sm-db-gen --verify-with-v1-db`. Every hash that's missing on either side or has differences is written to
+    the `report` as a json line."""
+    mismatches = Counter()
+
+    def write_report(hash_v3, status, differences=()):
+        entry = {
+            "hash": hash_v3,
+            "status": status,
+            "differences": [{"field": k, "ref": ref, "new": new} for k, ref, new in differences],
+        }
+        report.write(json.dumps(entry, sort_keys=True, default=str) + "\n")
+
+    chart = next(v2_charts, None)
+    hash_v3, reference = next(v1_references, (None, None))
+
+    while chart is not None or hash_v3 is not None:
+        if hash_v3 is None or (chart is not None and chart.hash < hash_v3):
+            mismatches["missing_edit" if chart.diff == "Edit" else "missing_reference"] += 1
+            write_report(chart.hash, "missing_in_v1")
+            chart = next(v2_charts, None)
+        elif chart is None or hash_v3 < chart.hash:
+            mismatches["missing_in_v2"] += 1
+            write_report(hash_v3, "missing_in_v2")
+            hash_v3, reference = next(v1_references, (None, None))
+        else:
+            differences = compare_with_reference(chart, reference, mismatches)
+            mismatches[f"n_mismatches {len(differences)}"] += 1
+            if differences:
+                write_report(chart.hash, "mismatch", differences)
+
+            chart = next(v2_charts, None)
+            hash_v3, reference = next(v1_references, (None, None))
+
+    return mismatches
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="Compares the whole v2 db against v1 db without parsing simfiles again",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "v1_db", type=Path, help="Path to v1 db or its index built with sm-db-v1-index", metavar="V1_DB"
+    )
+    parser.add_argument("--db", type=Path, default=Path("db_v2"), help="Path to the v2 db directory")
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=Path("verify_report.jsonl"),
+        help="Path to the report with a json line per every missing or mismatched hash",
+    )
+
+    return parser
+
+
+def main():
+    args = _get_parser().parse_args()
+
+    with open(args.report, "w") as report:
+        mismatches = verify(iter_v2_charts(args.db), iter_v1_references(args.v1_db), report)
+
+    pprint(mismatches)
+
+
+if __name__ == "__main__":
+    main()
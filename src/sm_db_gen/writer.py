@@ -0,0 +1,49 @@
+import concurrent.futures
+import os
+from collections import defaultdict
+from collections.abc import Callable, Iterable
+from pathlib import Path
+
+CHART_SHARDS = tuple(f"{i:02x}" for i in range(256))
+DEFAULT_WRITERS = 8
+
+
+def write_atomic(path: Path, content: str):
+    """Writes to a temporary file that is renamed afterwards, so that an interrupted save never leaves
+    a half-written file behind."""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(content)
+    os.replace(tmp_path, path)
+
+
+def prepare_db_dirs(path: Path) -> tuple[Path, Path]:
+    """Creates the `packs` directory and all the chart shard directories at once. Returns both top-level dirs."""
+    packs_dir = path / "packs"
+    packs_dir.mkdir(exist_ok=True, parents=True)
+
+    charts_dir = path / "charts"
+    for shard in CHART_SHARDS:
+        (charts_dir / shard).mkdir(exist_ok=True, parents=True)
+
+    return packs_dir, charts_dir
+
+
+def get_chart_path(charts_dir: Path, hash_v3: str) -> Path:
+    return charts_dir / hash_v3[:2] / f"{hash_v3[2:]}.json"
+
+
+def run_parallel(fn: Callable, items: Iterable, workers: int = DEFAULT_WRITERS) -> list:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fn, items))
+
+
+def run_by_shard(fn: Callable[[str], object], hashes: Iterable[str], workers: int = DEFAULT_WRITERS) -> list:
+    """Calls `fn` for every chart hash. Hashes are grouped by their shard directory, each group is handled by a single
+    worker, so that workers don't compete for the same directory."""
+    groups = defaultdict(list)
+    for hash_v3 in hashes:
+        groups[hash_v3[:2]].append(hash_v3)
+
+    results = run_parallel(lambda group: [fn(hash_v3) for hash_v3 in group], groups.values(), workers)
+
+    return [result for group_results in results for result in group_results]
@@ -0,0 +1,62 @@
+"""`sm-db-gen --hash-only -` writes csv to stdout, so nothing else may end up there, even for broken simfiles."""
+
+import csv
+import io
+import subprocess  # nosec
+import sys
+from pathlib import Path
+
+import pytest
+
+SIMFILE = """#TITLE:Song;
+#ARTIST:Artist;
+#BPMS:0.000=120.000;
+#NOTES:
+     dance-single:
+     :
+     Easy:
+     1:
+     0,0,0,0,0:
+1000
+0000
+0100
+0000
+;
+"""
+
+BROKEN_SIMFILES = {
+    # ssc tags in an sm file
+    "Broken/Tags/song.sm": "#TITLE:ssc;\n#BPMS:0=150;\n#NOTEDATA:;\n#STEPSTYPE:dance-single;\n#NOTES:\n1000\n;\n",
+    "Broken/Garbled/song.sm": b"#TITLE:\xff\xfe\x80;\n#BPMS:0=abc;\n#NOTES:\n  dance-single:\n:\n\x9d\x81;\n",
+    "Broken/Meter/song.sm": SIMFILE.replace("     1:", "     many:"),
+}
+
+
+@pytest.fixture
+def corpus(tmp_path: Path) -> Path:
+    for name, content in {"Pack/Song/song.sm": SIMFILE, **BROKEN_SIMFILES}.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True)
+        if isinstance(content, str):
+            content = content.encode()
+        path.write_bytes(content)
+
+    return tmp_path
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_stdout_is_pure_csv(corpus: Path, executor: str):
+    result = subprocess.run(  # nosec
+        [sys.executable, "-m", "sm_db_gen.gen", "--hash-only", "-", "--executor", executor, "--verbose", str(corpus)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    rows = list(csv.reader(io.StringIO(result.stdout)))
+    assert rows
+    for path, steps_type, diff, hash_v3 in rows:
+        assert Path(path).is_relative_to(corpus)
+        assert steps_type == "dance-single"
+        assert len(hash_v3) == 16
+    assert "Failures:" in result.stderr
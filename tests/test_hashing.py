@@ -0,0 +1,121 @@
+"""Property tests of chart minimization and hashing against the original implementation, which is kept here as the
+reference. Hashes are identifiers of charts in the db, so they have to stay bit-identical."""
+
+import random
+from hashlib import sha1
+
+import pytest
+
+from sm_db_gen.gen import hash_chart, minimize_measure, normalize_bpms
+
+SEEDS = range(20)
+ITERATIONS = 500
+BPMS = "0.000=150.000,\n32.000=75.5,"
+
+
+def reference_minimize_measure(measure):
+    beats = [b.strip() for b in measure.strip().splitlines()]
+    is_minimal = False
+
+    while not is_minimal and len(beats) % 2 == 0:
+        even_are_zeros = all(beats[i] == "0" * len(beats[i]) for i in range(1, len(beats), 2))
+        if even_are_zeros:
+            beats = [beats[i] for i in range(0, len(beats), 2)]
+        else:
+            is_minimal = True
+
+    return beats
+
+
+def reference_hash_chart(notes: str, raw_bpms: str) -> str:
+    measures = [m.strip() for m in notes.split(",")]
+    minimized_chart = []
+
+    for measure in measures:
+        if not measure:  # can happen when file ends with `,;`
+            continue
+        minimized_measure = reference_minimize_measure(measure)
+        minimized_chart.extend(minimized_measure)
+        minimized_chart.append(",")
+
+    minimized_chart_string = "\n".join(minimized_chart[:-1])
+    bpms = normalize_bpms(raw_bpms)
+
+    return sha1((minimized_chart_string + bpms).encode(), usedforsecurity=False).hexdigest()[:16]
+
+
+def random_row(rng: random.Random, width: int) -> str:
+    kind = rng.random()
+    if kind < 0.5:
+        return "0" * width
+    if kind < 0.55:
+        return ""  # blank row
+    if kind < 0.6:
+        return f"  {'0' * width}\t"  # padded with whitespace
+
+    return "".join(rng.choice("0000123M") for _ in range(width))
+
+
+def random_measure(rng: random.Random) -> str:
+    width = rng.choice((4, 8))
+    kind = rng.random()
+    if kind < 0.1:
+        rows = ["0" * width] * rng.choice((1, 2, 4, 16, 192))  # all zeros
+    elif kind < 0.4:
+        # notes only on a coarse grid of a fine measure, so it can be minimized a few times
+        rows_count = rng.choice((4, 8, 12, 16, 24, 32, 48, 64, 96, 192))
+        step = rng.choice([d for d in (1, 2, 3, 4, 8, 16) if rows_count % d == 0])
+        rows = [random_row(rng, width) if i % step == 0 else "0" * width for i in range(rows_count)]
+    else:
+        rows = [random_row(rng, width) for _ in range(rng.choice((1, 2, 3, 4, 5, 7, 8, 12, 16, 24, 192)))]
+
+    measure = "\n".join(rows)
+    if not measure.strip():
+        # the reference loops forever on an empty measure, see `test_empty_measure_is_minimal`
+        return random_measure(rng)
+
+    return measure
+
+
+def random_notes(rng: random.Random) -> str:
+    notes = ",\n".join(random_measure(rng) for _ in range(rng.randint(1, 20)))
+    if rng.random() < 0.2:
+        notes += ",\n"  # the file ends with `,;`
+
+    return f"\n{notes}\n"
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_minimize_measure_matches_reference(seed):
+    rng = random.Random(seed)
+    for _ in range(ITERATIONS):
+        measure = random_measure(rng)
+        assert minimize_measure(measure) == reference_minimize_measure(measure), measure
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_hash_chart_matches_reference(seed):
+    rng = random.Random(seed)
+    for _ in range(ITERATIONS // 10):
+        notes = random_notes(rng)
+        assert hash_chart(notes, BPMS) == reference_hash_chart(notes, BPMS), notes
+
+
+@pytest.mark.parametrize(
+    "notes",
+    [
+        "0000\n0000\n0000\n0000",
+        "1000\n0000\n\n0000\n0000",
+        "1000\n0000\n0100",
+        "1000\n0000,\n0000\n0000\n0000\n0000,\n",
+        "1000\n0000\n0000\n0000\n,\n  ",
+    ],
+)
+def test_hash_chart_edge_cases(notes):
+    assert hash_chart(notes, BPMS) == reference_hash_chart(notes, BPMS)
+
+
+def test_empty_measure_is_minimal():
+    # the reference loops forever on an empty measure
+    assert minimize_measure("") == []
+    assert minimize_measure(" \n ") == []